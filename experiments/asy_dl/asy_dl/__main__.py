@@ -3,47 +3,130 @@ import asyncio
 import os
 import aiohttp
 
-from bs4 import BeautifulSoup
 from indicator import progress, BrailleLoadingIndicator
+from webdownloader.cache import HttpCache
+from webdownloader.hosts import HostQueue, host
 
+from .pages import PageWriter
 
-def download_file_handler(content):
-    soup = BeautifulSoup(content, "html.parser")
-    filename = soup.title.string
-    with open(f"{filename}.html", "wb") as f:
-        f.write(content)
 
+async def fetch(session, url, cache: HttpCache = None, headers=None):
+    """Body and charset of url.
 
-async def download_file(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            content = await response.content.read()
-            download_file_handler(content)
+    The body is None if the server says the cached copy is current but it has
+    been evicted since.
+    """
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return await asyncio.to_thread(cache.read, url), cache.charset(url)
+        content = await response.content.read()
+        charset = response.charset
+    if cache is not None:
+        await asyncio.to_thread(
+            cache.store, url, response.headers, content, charset=charset
+        )
+    return content, charset
+
+
+async def download_file(
+    url, session: aiohttp.ClientSession, pages: PageWriter, cache: HttpCache = None
+):
+    headers = cache.headers(url) if cache is not None else None
+    content, charset = await fetch(session, url, cache, headers)
+    if content is None:
+        content, charset = await fetch(session, url, cache)
+    await pages.save(content, charset, url)
+
+
+def read_urls(url_list_path):
+    with open(url_list_path, "r") as f:
+        for line in f:
+            if url := line.strip():
+                yield url
+
+
+async def download_worker(
+    queue: HostQueue,
+    session: aiohttp.ClientSession,
+    pages: PageWriter,
+    cache: HttpCache = None,
+):
+    while True:
+        url = await queue.get()
+        try:
+            await download_file(url, session, pages, cache)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Failed to download {url}: {e}")
+        finally:
+            queue.task_done(url)
 
 
 # indicator = BrailleLoadingIndicator()
 # @progress(indicator)
-async def download_batch(batch_urls):
-    tasks = []
-    for url in batch_urls:
-        tasks.append(asyncio.ensure_future(download_file(url)))
-    await asyncio.gather(*tasks)
+async def download_all(
+    url_list_path,
+    concurrency=10,
+    per_host=2,
+    host_delay=0.0,
+    cache: HttpCache = None,
+    parsers=None,
+):
+    """Keep concurrency downloads in flight over one pooled session.
 
+    Each worker starts its next URL as soon as its last one finishes, so a
+    slow page only holds up its own slot. URLs are read from the file as the
+    bounded queue drains and handed out round-robin across hosts, at most
+    per_host at a time per host. Pages are parsed and written by a pool of
+    parsers processes.
+    """
+    queue = HostQueue(concurrency * 4, per_host, host_delay, key=host)
+    connector = aiohttp.TCPConnector(
+        limit=concurrency, limit_per_host=per_host, ttl_dns_cache=300
+    )
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+    pages = PageWriter(os.getcwd(), parsers)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workers = [
+            asyncio.create_task(download_worker(queue, session, pages, cache))
+            for _ in range(concurrency)
+        ]
+        try:
+            for url in read_urls(url_list_path):
+                await queue.put(url)
+            await queue.join()
+            await pages.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await asyncio.to_thread(pages.close)
 
-def download_files(url_list_path, batch_size=10):
-    with open(url_list_path, "r") as f:
-        urls = [url for url in f.read().splitlines() if url]
+
+def download_files(
+    url_list_path,
+    concurrency=10,
+    per_host=2,
+    host_delay=0.0,
+    cache: HttpCache = None,
+    parsers=None,
+):
+    url_list_path = os.path.abspath(url_list_path)
 
     # make download directory
     os.makedirs("downloads", exist_ok=True)
     os.chdir("downloads")
 
-    loop = asyncio.get_event_loop()
     try:
-        for i in range(0, len(urls), batch_size):
-            batch_urls = urls[i : i + batch_size]
-            loop.run_until_complete(download_batch(batch_urls))
+        asyncio.run(
+            download_all(
+                url_list_path, concurrency, per_host, host_delay, cache, parsers
+            )
+        )
     finally:
+        if cache is not None:
+            cache.save()
         print("Done!")
 
     os.chdir("..")
@@ -55,12 +138,57 @@ def main():
         "file_path", metavar="FILE", help="Path to file containing URLs"
     )
     parser.add_argument(
+        "-c",
+        "--concurrency",
         "-b",
         "--batch-size",
+        dest="concurrency",
         type=int,
         default=10,
-        help="Number of files to download in each batch",
+        help="Number of downloads in flight at once",
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=2,
+        help="Maximum concurrent downloads from one host",
+    )
+    parser.add_argument(
+        "--host-delay",
+        type=float,
+        default=0.0,
+        help="Minimum seconds between the starts of requests to one host",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="Directory to cache pages in for conditional re-downloads",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=1024, help="Cache size limit in MiB"
+    )
+    parser.add_argument(
+        "-p",
+        "--parsers",
+        type=int,
+        default=None,
+        help="Processes parsing and writing pages, default one per CPU",
     )
     args = parser.parse_args()
 
-    download_files(args.file_path, batch_size=args.batch_size)
+    download_files(
+        args.file_path,
+        concurrency=args.concurrency,
+        per_host=args.per_host,
+        host_delay=args.host_delay,
+        cache=(
+            HttpCache(os.path.abspath(args.cache), args.cache_size << 20)
+            if args.cache
+            else None
+        ),
+        parsers=args.parsers,
+    )
+
+
+if __name__ == "__main__":
+    main()
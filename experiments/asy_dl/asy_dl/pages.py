@@ -0,0 +1,133 @@
+"""Saving downloaded pages under their title, run in worker processes.
+
+Finding the title only needs the start of the page, so `title` feeds the
+page to an `HTMLParser` a block at a time and stops at the first `</title>`
+instead of building a tree of the whole document. Pages it can't find a
+title in this way go through BeautifulSoup as before.
+
+The page is decoded with the charset of the response, or else the one its
+byte order mark or `<meta>` tags declare, like BeautifulSoup would.
+"""
+
+import asyncio
+import codecs
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from html.parser import HTMLParser
+
+from bs4 import BeautifulSoup
+from bs4.dammit import EncodingDetector
+
+BLOCK = 1 << 14
+
+# workers start on the first submit, when the loop's to_thread threads may be
+# running already, and a process forked from threads can deadlock
+START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+class _Found(Exception):
+    pass
+
+
+class TitleParser(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.in_title = False
+        self.parts = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self.in_title = True
+
+    def handle_endtag(self, tag):
+        if tag == "title" and self.in_title:
+            raise _Found
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.parts.append(data)
+
+
+def _encoding(content: bytes, charset: str = None) -> str:
+    """charset if given, else what the start of the page declares, else UTF-8"""
+    if charset:
+        return charset
+    _, sniffed = EncodingDetector.strip_byte_order_mark(content[:4])
+    declared = EncodingDetector.find_declared_encoding(content[:BLOCK], is_html=True)
+    return sniffed or declared or "utf-8"
+
+
+def title(content: bytes, charset: str = None) -> str:
+    """Text of the page's first <title>, None if there isn't one"""
+    try:
+        decoder = codecs.getincrementaldecoder(_encoding(content, charset))(
+            errors="replace"
+        )
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parser = TitleParser()
+    try:
+        for start in range(0, len(content), BLOCK):
+            parser.feed(decoder.decode(content[start : start + BLOCK]))
+        parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+    except _Found:
+        return "".join(parser.parts)
+    # no closing tag seen, let BeautifulSoup make sense of it
+    soup = BeautifulSoup(content, "html.parser")
+    return soup.title.string if soup.title is not None else None
+
+
+def save_page(content: bytes, directory: str, charset: str = None) -> str:
+    """Write content to <title>.html in directory, return the file name"""
+    name = title(content, charset)
+    if name is None:
+        raise ValueError("page has no title")
+    filename = f"{name}.html"
+    with open(os.path.join(directory, filename), "wb") as f:
+        f.write(content)
+    return filename
+
+
+class PageWriter:
+    """Runs `save_page` in a process pool, with at most backlog pages waiting on it.
+
+    `save` returns as soon as the page is handed to the pool and only blocks
+    when the pool has fallen that far behind, so downloads keep the network
+    busy while pages are parsed on every core.
+    """
+
+    def __init__(self, directory: str, workers: int = None, backlog: int = None):
+        self.directory = directory
+        self.workers = workers or os.cpu_count()
+        self.pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context(START_METHOD)
+        )
+        self._slots = asyncio.Semaphore(backlog or 2 * self.workers)
+        self._pending: set[asyncio.Future] = set()
+
+    async def save(self, content: bytes, charset: str = None, url: str = None):
+        await self._slots.acquire()
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(
+            self.pool, save_page, content, self.directory, charset
+        )
+        self._pending.add(future)
+        future.add_done_callback(partial(self._saved, url))
+
+    def _saved(self, url, future):
+        self._slots.release()
+        self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Failed to save {url}: {future.exception()}")
+
+    async def join(self):
+        """Wait for every page handed to save so far"""
+        await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def close(self):
+        self.pool.shutdown()
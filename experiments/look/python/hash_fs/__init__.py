@@ -1,3 +1,4 @@
 from .__main__ import HashTree, Node
+from .compact import CompactTree
 
-__all__ = ["HashTree", "Node"]
+__all__ = ["HashTree", "Node", "CompactTree"]
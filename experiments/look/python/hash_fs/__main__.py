@@ -1,9 +1,36 @@
+from contextlib import contextmanager
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 from dataclasses import Field, dataclass
+import argparse
+from binascii import hexlify, unhexlify
+import bisect
 import glob
 from hashlib import sha256
+import multiprocessing
+import os
+import sys
+from stat import S_ISDIR, S_ISREG
+import struct
+import time
 from typing import Any
 from uuid import uuid4
 
+from .chunking import Chunker, chunk_file
+from .dedup import DedupIndex
+from .hashing import DEFAULT, Hasher
+from .snapshot import SnapshotCache
+
+# the hashing pool starts while the walker threads are running, and a process
+# forked from threads can deadlock
+START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 
 class Node:
     def __init__(self, data=b"", children=None):
@@ -11,6 +38,7 @@ class Node:
         self._parent: "Node" = None
         self._children: list["Node"] = children or []
         self._data: Any = data
+        self._tree: "HashTree" = None
 
         self.update()
 
@@ -47,16 +75,27 @@ class Node:
         return self._children
 
     def add_child(self, child: "Node"):
-        self._children.append(child)
+        self.children.append(child)
         child.parent = self
 
+    @property
+    def hasher(self) -> Hasher:
+        return DEFAULT if self._tree is None else self._tree.hasher
+
+    def hash_parts(self, sha: bytes = None) -> list[bytes]:
+        """The digests this node hashes together, children last.
+
+        sha is the digest of the node's data when it was already computed.
+        """
+        if sha is None:
+            sha = self.hasher.digest(self.data)
+        return [sha] + [child.hid for child in self.children]
+
     def __hash__(self) -> bytes:
-        sha = sha256(self._data).hexdigest().encode()
-        if len(self.children) == 0:
-            return sha
-        else:
-            shas = [sha] + [child.hid for child in self.children]
-            return sha256(b"".join(shas)).hexdigest().encode()
+        shas = self.hash_parts()
+        if len(shas) == 1:
+            return shas[0]
+        return self.hasher.digest(b"".join(shas))
 
     def get_root_path(self, node: "Node"):
         """Get the path from node to root. Assumes that node is in the tree."""
@@ -65,10 +104,20 @@ class Node:
             node = node.parent
 
     def update(self, changed_node: "Node" = None):
-        """Update hashes of all nodes in the path from changed_node to root"""
+        """Update hashes of all nodes in the path from changed_node to root.
+
+        Inside a `HashTree.batch` the update is deferred until the batch ends.
+        """
         changed_node = changed_node or self
+        tree = changed_node._tree
+        if tree is not None and tree.batching:
+            tree.defer(changed_node)
+            return
+
         for node in self.get_root_path(changed_node):
             node.hid = node.__hash__()
+            if node._tree is not None:
+                node._tree.mark_dirty(node)
 
     def __str__(self):
         return f"{self.hid}: {self.data}"
@@ -77,80 +126,867 @@ class Node:
         return f"N({self.data})"
 
 
+class NodeSet:
+    """The nodes of a tree in insertion order, keyed by id so removal is O(1)"""
+
+    def __init__(self, nodes=()):
+        self._nodes: dict[int, Node] = {id(node): node for node in nodes}
+
+    def append(self, node: Node):
+        self._nodes[id(node)] = node
+
+    def discard(self, node: Node):
+        self._nodes.pop(id(node), None)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes.values())
+
+
 class HashTree:
     """A  hash tree for file system.
 
     Every node is a hash value of its children.
+
+    Nodes whose hid may have left the cache are tracked in a dirty set, so
+    `invalid_nodes` only has to look at nodes that changed since they were
+    last validated. When the whole cache is swapped out every node is
+    considered dirty and the next `invalid_nodes` does one full pass.
+
+    Nodes with the same hid share one cache entry, so a node is also only
+    valid as long as the node cached under its hid keeps that hid. Nodes
+    validated against another node's entry are remembered as its sharers and
+    marked dirty along with it.
+
+    Mutations made inside `batch()` don't rehash anything until the batch
+    ends, then every touched node is rehashed exactly once, deepest first.
+    Each level goes through `Hasher.digest_many`, which hashes large node
+    data on a thread pool.
+
+    The cache is a `SnapshotCache`: dumped histories are immutable snapshots
+    that share structure with the live cache, so each one only costs memory
+    for what changed since the previous one, and restoring is O(1).
     """
 
-    def __init__(self, root: Node):
+    def __init__(self, root: Node, hasher: Hasher = None, hashed=False):
+        """Make a tree of root and the nodes already linked under it.
+
+        They are rehashed with hasher, unless hashed says their hids already
+        come from it, as for nodes loaded from a saved tree.
+        """
         self.root = root
-        self.nodes = [root]
-        self.cache = {}
+        self.hasher = hasher or DEFAULT
+        self.nodes = NodeSet()
+        self.cache = SnapshotCache()
         self.cache_histories = []
+        self.dirty: dict[int, Node] = {}
+        self._sharers: dict[int, dict[int, Node]] = {}
+        self._all_dirty = False
+        self._batch_depth = 0
+        self._deferred: dict[int, Node] = {}
+        self._recache: dict[int, Node] = {}
+
+        nodes = self._adopt(root)
+        if not hashed:
+            for node in nodes:
+                self.defer(node)
+            self.commit()
+
+    def _adopt(self, node: Node) -> list[Node]:
+        """Register node and the nodes linked under it, parents first"""
+        order = [node]
+        for current in order:
+            current._tree = self
+            self.nodes.append(current)
+            self.mark_dirty(current)
+            for child in current.children:
+                child._parent = current
+                order.append(child)
+        return order
 
     def append_to(self, parent: Node, child: Node):
-        """Append child to parent"""
-        parent.add_child(child)
-        self.nodes.append(child)
+        """Append child and the nodes linked under it to parent"""
+        with self.batch():
+            # hashed before they joined the tree, so with the default hasher
+            for node in self._adopt(child):
+                self.defer(node)
+            parent.add_child(child)
+
+    def add_nodes(self, nodes: list[Node]):
+        """Register nodes that were already linked into the tree"""
+        for node in nodes:
+            node._tree = self
+            self.nodes.append(node)
+            self.mark_dirty(node)
+
+    def remove_nodes(self, nodes: list[Node]):
+        """Forget nodes that were unlinked from the tree"""
+        for node in nodes:
+            self.nodes.discard(node)
+            node._tree = None
+            self.dirty.pop(id(node), None)
+
+    @property
+    def batching(self):
+        return self._batch_depth > 0
+
+    @contextmanager
+    def batch(self):
+        """Defer rehashing until the outermost batch exits.
+
+        Hids read inside the batch may be stale.
+        """
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.commit()
+
+    def defer(self, node: Node):
+        """Remember that the path from node to root needs rehashing"""
+        self._deferred[id(node)] = node
+
+    def commit(self) -> int:
+        """Rehash every node on the deferred paths once, deepest first.
+
+        Returns the number of rehashed nodes.
+        """
+        deferred, self._deferred = self._deferred, {}
+        depths: dict[int, tuple[int, Node]] = {}
+        for node in deferred.values():
+            path = []
+            while node is not None and id(node) not in depths:
+                path.append(node)
+                node = node.parent
+            depth = -1 if node is None else depths[id(node)][0]
+            for node in reversed(path):
+                depth += 1
+                depths[id(node)] = (depth, node)
+
+        levels: dict[int, list[Node]] = {}
+        for depth, node in depths.values():
+            levels.setdefault(depth, []).append(node)
+        for depth in sorted(levels, reverse=True):
+            self._rehash_level(levels[depth])
+
+        recache, self._recache = self._recache, {}
+        cached = set()
+        for node in recache.values():
+            for ancestor in node.get_root_path(node):
+                if id(ancestor) in cached:
+                    break
+                cached.add(id(ancestor))
+                self._cache(ancestor)
+
+        return len(depths)
+
+    def _rehash_level(self, level: list[Node]):
+        """Rehash nodes whose children are all up to date"""
+        shas = self.hasher.digest_many([node.data for node in level])
+        parts = [node.hash_parts(sha) for node, sha in zip(level, shas)]
+        joined = [i for i, shas in enumerate(parts) if len(shas) > 1]
+        digests = self.hasher.digest_many([b"".join(parts[i]) for i in joined])
+        for i, digest in zip(joined, digests):
+            parts[i] = [digest]
+        for node, shas in zip(level, parts):
+            node.hid = shas[0]
+            if node._tree is not None:
+                node._tree.mark_dirty(node)
+
+    def rehash(self):
+        """Rehash the whole tree, one level at a time"""
+        for node in self.nodes:
+            self.defer(node)
+        return self.commit()
+
+    def mark_dirty(self, node: Node):
+        """Flag node and the nodes sharing its cache entry for `invalid_nodes`"""
+        self.dirty[id(node)] = node
+        self._mark_sharers(node)
+
+    def _mark_sharers(self, node: Node):
+        """Flag the nodes that were validated against node's cache entry"""
+        for key, sharer in self._sharers.pop(id(node), {}).items():
+            if sharer._tree is self:
+                self.dirty[key] = sharer
+
+    def mark_all_dirty(self):
+        self.dirty.clear()
+        self._sharers.clear()
+        self._all_dirty = True
 
     def initialize_cache(self):
         """Generate cache for the tree to check against invalidation"""
-        self.cache = {node.hid: node for node in self.nodes}
+        self.cache = SnapshotCache()
+        for node in self.nodes:
+            self.cache[node.hid] = node
+        self.dirty.clear()
+        self._sharers.clear()
+        self._all_dirty = False
+        for node in self.nodes:
+            self._is_invalid(node)
 
     def dump_cache(self, clear_cache=False):
-        """Dump cache to cache histories"""
-        self.cache_histories.append(self.cache)
+        """Dump a snapshot of the cache to cache histories"""
+        self.cache_histories.append(self.cache.snapshot())
         if clear_cache:
-            self.cache = {}
+            self.cache = SnapshotCache()
+            self.mark_all_dirty()
 
     def restore_cache(self, swap_cache=False):
         """Restore cache from cache histories"""
         if swap_cache:
-            saved = self.cache
-            self.cache = self.cache_histories.pop()
+            saved = self.cache.snapshot()
+            self.cache = SnapshotCache(self.cache_histories.pop())
             self.cache_histories.append(saved)
         else:
-            self.cache = self.cache_histories.pop()
+            self.cache = SnapshotCache(self.cache_histories.pop())
+        self.mark_all_dirty()
 
     def save(self, path: str):
-        """Save the tree to path"""
-        ...
+        """Save the tree to path in the binary format of `storage`"""
+        from .storage import save_tree
+
+        save_tree(self.root, path)
+
+    def close(self):
+        """Unmap a tree loaded with `load`, untouched nodes become unreadable"""
+        if hasattr(self.nodes, "close"):
+            self.nodes.close()
 
     def load(self, path: str):
-        """Load the tree from path"""
-        ...
+        """Load the tree from path.
+
+        The file is memory-mapped and nodes are only materialized when touched,
+        so loading is O(1) regardless of the tree size. The mapping stays open
+        until `close` or the next `load`.
+        """
+        from .storage import load_tree
+
+        nodes = load_tree(path, self.hasher)
+        self.close()
+        self.nodes = nodes
+        self.nodes.tree = self
+        self.root = self.nodes[0]
+        self.cache = SnapshotCache()
+        self.mark_all_dirty()
+        return self
+
+    def diff(self, old):
+        """Yield the changes from old (a HashTree, root Node or saved tree) to this"""
+        from .diff import diff
+
+        return diff(old, self)
+
+    def _is_invalid(self, node: Node):
+        cached = self.cache.get(node.hid)
+        if cached is None or cached.hid != node.hid:
+            return True
+        if cached is not node:
+            self._sharers.setdefault(id(cached), {})[id(node)] = node
+        return False
 
     @property
     def invalid_nodes(self):
-        """Return invalidated nodes or empty list if no nodes are invalidated"""
-        return [
-            node
-            for node in self.nodes
-            if node.hid not in self.cache or node.hid != self.cache[node.hid].hid
-        ]
+        """Return invalidated nodes or empty list if no nodes are invalidated.
+
+        Costs O(dirty): dirty nodes that turn out to be valid are dropped from
+        the dirty set.
+        """
+        if self._all_dirty:
+            self._all_dirty = False
+            self.dirty = {
+                id(node): node for node in self.nodes if self._is_invalid(node)
+            }
+            return list(self.dirty.values())
+
+        invalid = []
+        for key, node in list(self.dirty.items()):
+            if self._is_invalid(node):
+                invalid.append(node)
+            else:
+                del self.dirty[key]
+        return invalid
 
     def invalidate_ancestry(self, node: Node):
         """Invalidate ancestry of node"""
-        for ancestor in node.get_root_path(node):
-            if ancestor.hid in self.cache:
-                del self.cache[ancestor.hid]
+        for ancestor in reversed(list(node.get_root_path(node))):
+            cached = self.cache.pop(ancestor.hid, None)
+            if cached is not None:
+                self.mark_dirty(cached)
+            self.mark_dirty(ancestor)
 
     def update_ancestry(self, node: Node):
         """Update node and its ancestry"""
         node.update()
-        self.cache[node.hid] = node
+        if self.batching:
+            self._recache[id(node)] = node
+            return
         for ancestor in node.get_root_path(node):
-            self.cache[ancestor.hid] = ancestor
+            self._cache(ancestor)
+
+    def _cache(self, node: Node):
+        """Make node the cache entry for its hid and drop it from the dirty set"""
+        previous = self.cache.get(node.hid)
+        self.cache[node.hid] = node
+        self.dirty.pop(id(node), None)
+        if previous is not None and previous is not node:
+            # what was validated against the old entry now depends on node
+            self._mark_sharers(previous)
+            if previous._tree is self:
+                self.dirty[id(previous)] = previous
+
+
+class FSNode(Node):
+    """Node for a filesystem entry, its data is the entry name.
+
+    Files carry the digest of their content instead of the content itself, so
+    a file hashes the same way a node with a single child would. Files also
+    keep the (inode, size, mtime_ns) they were hashed at, directories have no
+    stat.
+    """
+
+    def __init__(self, name: str, digest: bytes = b"", children=None, stat=None):
+        self.name = name
+        self.digest = digest
+        self.stat: tuple[int, int, int] | None = stat
+        super().__init__(os.fsencode(name), children)
+
+    @classmethod
+    def restore(cls, name: str, hid: bytes, digest: bytes = b"", stat=None):
+        """Recreate a node with a known hid without hashing anything"""
+        node = cls.__new__(cls)
+        node.name = name
+        node.digest = digest
+        node.stat = stat
+        node._hid = hid
+        node._parent = None
+        node._children = []
+        node._data = os.fsencode(name)
+        node._tree = None
+        return node
+
+    @property
+    def is_file(self):
+        return self.stat is not None
+
+    def hash_parts(self, sha: bytes = None) -> list[bytes]:
+        if sha is None:
+            sha = self.hasher.digest(self.data)
+        return [sha, self.digest] + [child.hid for child in self.children]
+
+    def __repr__(self):
+        return f"FSN({self.name})"
+
+
+class Chunk(FSNode):
+    """Content-defined chunk of a large file.
+
+    A chunk hashes to the digest of its content digest alone, so it keeps its
+    hid no matter where in the file it ends up. The content digest is always
+    sha256, hashing it again gives the hid the tree's digest size.
+    """
+
+    def __init__(self, digest: bytes, size: int):
+        self.size = size
+        super().__init__(digest.decode(), digest)
+
+    def hash_parts(self, sha: bytes = None) -> list[bytes]:
+        # the data is the content digest
+        if sha is None:
+            sha = self.hasher.digest(self.data)
+        return [sha]
+
+    def __repr__(self):
+        return f"Chunk({self.name[:12]})"
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> tuple[bytes, int]:
+    """Return the content digest and size of the file at path"""
+    sha = sha256()
+    size = 0
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            sha.update(view[:n])
+            size += n
+    return sha.hexdigest().encode(), size
+
+
+def hash_files(
+    files: list[tuple[str, int]], chunker: Chunker = None
+) -> list[tuple | None]:
+    """Hash a batch of (path, size) files into (digest, size, chunks).
+
+    Files larger than the chunker's max_size are split into content-defined
+    chunks, other files have no chunks. Files that can't be read are None.
+    """
+    results = []
+    for path, size in files:
+        try:
+            if chunker is not None and size > chunker.max_size:
+                results.append(chunk_file(path, chunker))
+            else:
+                results.append((*hash_file(path), []))
+        except OSError:
+            results.append(None)
+    return results
+
+
+def scan_dir(path: str) -> tuple[list[str], list[tuple[str, tuple[int, int, int]]]]:
+    """List the subdirectories and regular files in path, symlinks are skipped.
+
+    Files are listed with their (inode, size, mtime_ns).
+    """
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        st = entry.stat(follow_symlinks=False)
+                        files.append(
+                            (entry.name, (st.st_ino, st.st_size, st.st_mtime_ns))
+                        )
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return dirs, files
+
+
+@dataclass
+class IndexStats:
+    files: int = 0
+    dirs: int = 0
+    bytes: int = 0
+    unchanged: int = 0
+    seconds: float = 0.0
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return (
+            f"{self.files} files hashed ({self.unchanged} unchanged), "
+            f"{self.dirs} dirs, "
+            f"{self.bytes} bytes in {self.seconds:.2f}s "
+            f"({self.files_per_second:.0f} files/s, "
+            f"{self.bytes_per_second / (1 << 20):.1f} MiB/s)"
+        )
 
 
 class FSIndex:
-    """Index for file system"""
+    """Index for file system.
 
-    ...
+    Directories are scanned concurrently on a thread pool while file contents
+    are hashed in batches on a thread (or process) pool. Once the walk is done
+    the tree is assembled bottom-up so every directory is hashed exactly once.
 
+    `rescan` only re-reads files whose (inode, size, mtime_ns) changed and only
+    rehashes the ancestors of what changed.
 
-def main():
+    Files larger than the chunker's max_size get one `Chunk` child per
+    content-defined chunk, so an edit only replaces the chunks around it.
+
+    `dedup` maps every file digest to its paths and is kept current by
+    `rescan`, so duplicate queries never re-hash anything.
+    """
+
+    STAT = struct.Struct("<BQQq32s")
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = None,
+        processes=False,
+        batch_bytes=1 << 24,
+        chunk_size=1 << 20,
+        hasher: Hasher = None,
+    ):
+        self.path = os.path.abspath(path)
+        self.workers = workers or os.cpu_count()
+        self.processes = processes
+        self.batch_bytes = batch_bytes
+        self.chunker = Chunker(chunk_size) if chunk_size else None
+        self.hasher = hasher or DEFAULT
+
+        self.tree: HashTree = None
+        self.entries: dict[str, FSNode] = {}
+        self.dedup = DedupIndex()
+        self.stats = IndexStats()
+
+    def _batches(self, files: list[tuple[str, tuple]]):
+        batch, size = [], 0
+        for name, stat in files:
+            batch.append((name, stat))
+            size += stat[1]
+            if size >= self.batch_bytes or len(batch) >= 256:
+                yield batch
+                batch, size = [], 0
+        if batch:
+            yield batch
+
+    def _walk(self, stats: IndexStats, known: dict[str, FSNode] = None, root: str = ""):
+        """Scan and hash everything under the relative path root.
+
+        Files in known whose stat didn't change keep their digest without being
+        read. Returns the directory listings and a {path: (digest, stat, chunks)}
+        dict, where chunks is None for files that weren't read.
+        """
+        known = known or {}
+        listings: dict[str, tuple[list[str], list[str]]] = {}
+        files: dict[str, tuple[bytes, tuple, list | None]] = {}
+        if self.processes:
+            hashers = ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context(START_METHOD)
+            )
+        else:
+            hashers = ThreadPoolExecutor(self.workers)
+
+        with ThreadPoolExecutor(self.workers) as walkers, hashers:
+            start = walkers.submit(scan_dir, os.path.join(self.path, root))
+            pending = {start: (root, None)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rel, batch = pending.pop(future)
+                    if batch is None:
+                        dirs, listed = future.result()
+                        listings[rel] = (dirs, [name for name, _ in listed])
+                        for name in dirs:
+                            sub = os.path.join(rel, name)
+                            scan = walkers.submit(
+                                scan_dir, os.path.join(self.path, sub)
+                            )
+                            pending[scan] = (sub, None)
+
+                        stale = []
+                        for name, stat in listed:
+                            path = os.path.join(rel, name)
+                            node = known.get(path)
+                            if node is not None and node.stat == stat:
+                                files[path] = (node.digest, stat, None)
+                                stats.unchanged += 1
+                            else:
+                                stale.append((name, stat))
+                        for batch in self._batches(stale):
+                            paths = [
+                                (os.path.join(self.path, rel, name), stat[1])
+                                for name, stat in batch
+                            ]
+                            hashing = hashers.submit(hash_files, paths, self.chunker)
+                            pending[hashing] = (rel, batch)
+                    else:
+                        for (name, stat), result in zip(batch, future.result()):
+                            if result is None:
+                                continue
+                            digest, size, chunks = result
+                            files[os.path.join(rel, name)] = (digest, stat, chunks)
+                            stats.files += 1
+                            stats.bytes += size
+
+        stats.dirs = len(listings)
+        return listings, files
+
+    def build(self) -> HashTree:
+        """Walk the filesystem and build the matching HashTree"""
+        stats = IndexStats()
+        start = time.perf_counter()
+        listings, files = self._walk(stats)
+
+        entries: dict[str, FSNode] = {}
+        depth = {rel: rel.count(os.sep) + bool(rel) for rel in listings}
+        for rel in sorted(listings, key=depth.get, reverse=True):
+            dirs, names = listings[rel]
+            children = [entries[os.path.join(rel, name)] for name in dirs]
+            for name in names:
+                path = os.path.join(rel, name)
+                if path in files:
+                    entries[path] = self._file_node(name, *files[path])
+                    children.append(entries[path])
+            children.sort(key=lambda child: child.name)
+
+            node = FSNode.restore(os.path.basename(rel or self.path), None)
+            self._link(node, children)
+            entries[rel] = node
+
+        # nodes are linked unhashed, the tree hashes them one level at a time
+        self.tree = HashTree(entries[""], self.hasher)
+        self.entries = entries
+        self._index_duplicates()
+
+        stats.seconds = time.perf_counter() - start
+        self.stats = stats
+        return self.tree
+
+    def _index_duplicates(self):
+        self.dedup = DedupIndex()
+        for rel, node in self.entries.items():
+            if node.is_file:
+                self.dedup.add(rel, node.digest, node.stat[1])
+
+    @staticmethod
+    def _link(node: FSNode, children: list[FSNode]):
+        node._children = children
+        for child in children:
+            child._parent = node
+
+    def _file_node(self, name: str, digest: bytes, stat: tuple, chunks: list) -> FSNode:
+        node = FSNode.restore(name, None, digest, stat)
+        self._link(node, [Chunk(*chunk) for chunk in chunks])
+        return node
+
+    def _rechunk(self, node: FSNode, chunks: list) -> list[Chunk]:
+        """Replace the chunks of node, keeping the Chunk nodes whose digest is the same.
+
+        Returns the chunks that were dropped.
+        """
+        old: dict[bytes, list[Chunk]] = {}
+        for chunk in node.children:
+            old.setdefault(chunk.digest, []).append(chunk)
+        children, fresh = [], []
+        for digest, size in chunks:
+            if old.get(digest):
+                children.append(old[digest].pop())
+            else:
+                fresh.append(Chunk(digest, size))
+                children.append(fresh[-1])
+        self._link(node, children)
+        self.tree.add_nodes(fresh)
+        return [chunk for stale in old.values() for chunk in stale]
+
+    def _attach(self, rel: str, node: FSNode):
+        parent = self.entries[os.path.dirname(rel)]
+        position = bisect.bisect(parent.children, node.name, key=lambda c: c.name)
+        parent.children.insert(position, node)
+        node._parent = parent
+        self.entries[rel] = node
+        self.tree.add_nodes([node, *node.children])
+
+    def _subtree(self, rel: str, node: FSNode):
+        """Yield (relative path, node) for node and every entry below it"""
+        stack = [(rel, node)]
+        while stack:
+            rel, node = stack.pop()
+            yield rel, node
+            if not node.is_file:
+                stack.extend(
+                    (os.path.join(rel, child.name), child) for child in node.children
+                )
+
+    def _apply(self, gone: list[str], listings: dict, files: dict):
+        """Drop the gone entries, add or update the walked ones.
+
+        Their ancestors are rehashed in one batch.
+        """
+        entries = self.entries
+        changed: list[FSNode] = []
+        removed = {}
+        for rel in sorted(gone, key=len):
+            node = entries.pop(rel)
+            removed[id(node)] = node
+            if node.is_file:
+                removed.update((id(chunk), chunk) for chunk in node.children)
+                self.dedup.discard(rel, node.digest)
+            parent = node.parent
+            if id(parent) not in removed:
+                parent.children.remove(node)
+                changed.append(parent)
+            node._parent = None
+
+        for rel in sorted(listings, key=len):
+            if rel not in entries:
+                self._attach(rel, FSNode(os.path.basename(rel)))
+                changed.append(entries[rel])
+
+        for rel, (digest, stat, chunks) in files.items():
+            node = entries.get(rel)
+            if node is None:
+                self._attach(
+                    rel, self._file_node(os.path.basename(rel), digest, stat, chunks)
+                )
+                self.dedup.add(rel, digest, stat[1])
+                changed.extend([entries[rel], *entries[rel].children])
+            elif node.digest != digest:
+                self.dedup.discard(rel, node.digest)
+                self.dedup.add(rel, digest, stat[1])
+                node.digest, node.stat = digest, stat
+                for chunk in self._rechunk(node, chunks):
+                    removed[id(chunk)] = chunk
+                changed.extend([node, *node.children])
+            else:
+                node.stat = stat
+
+        if removed:
+            self.tree.remove_nodes(list(removed.values()))
+        with self.tree.batch():
+            for node in changed:
+                if id(node) not in removed:
+                    self.tree.update_ancestry(node)
+
+    def rescan(self) -> HashTree:
+        """Bring the tree up to date with the filesystem.
+
+        Only files whose stat changed are re-read and only the ancestors of
+        modified, added or removed entries are rehashed.
+        """
+        if self.tree is None:
+            return self.build()
+
+        stats = IndexStats()
+        start = time.perf_counter()
+        known = {rel: node for rel, node in self.entries.items() if node.is_file}
+        listings, files = self._walk(stats, known)
+        gone = [
+            rel
+            for rel, node in self.entries.items()
+            if rel and rel not in (files if node.is_file else listings)
+        ]
+        self._apply(gone, listings, files)
+
+        stats.seconds = time.perf_counter() - start
+        self.stats = stats
+        return self.tree
+
+    def refresh(self, paths) -> HashTree:
+        """Bring only the given relative paths up to date, e.g. those a watch reports.
+
+        New directories are walked in full, removed ones are dropped along with
+        everything below them and files are only re-read if their stat changed.
+        """
+        stats = IndexStats()
+        start = time.perf_counter()
+        gone, listings, files, stale = {}, {}, {}, []
+
+        for rel in sorted(set(paths), key=len):
+            parent = os.path.dirname(rel)
+            if (
+                not rel
+                or rel in listings
+                or parent in listings
+                or parent in gone
+                or parent not in self.entries
+            ):
+                continue
+            try:
+                st = os.lstat(os.path.join(self.path, rel))
+                is_dir, is_file = S_ISDIR(st.st_mode), S_ISREG(st.st_mode)
+            except OSError:
+                is_dir = is_file = False
+
+            node = self.entries.get(rel)
+            if node is not None and (node.is_file, not node.is_file) != (
+                is_file,
+                is_dir,
+            ):
+                gone.update(self._subtree(rel, node))
+                node = None
+
+            if is_dir and node is None:
+                walked, walked_files = self._walk(stats, root=rel)
+                listings.update(walked)
+                files.update(walked_files)
+            elif is_file:
+                stat = (st.st_ino, st.st_size, st.st_mtime_ns)
+                if node is None or node.stat != stat:
+                    stale.append((rel, stat))
+
+        found = [(os.path.join(self.path, rel), stat[1]) for rel, stat in stale]
+        for (rel, stat), result in zip(stale, hash_files(found, self.chunker)):
+            if result is not None:
+                digest, size, chunks = result
+                files[rel] = (digest, stat, chunks)
+                stats.files += 1
+                stats.bytes += size
+
+        self._apply(gone, listings, files)
+        stats.seconds = time.perf_counter() - start
+        self.stats = stats
+        return self.tree
+
+    def search_index(self):
+        """A PathIndex over the relative paths of the indexed files"""
+        from .search import PathIndex
+
+        return PathIndex.build(
+            rel for rel, node in self.entries.items() if node.is_file
+        )
+
+    def save(self, path: str, paths=None):
+        """Save the tree to path and the stat of every file to path.stat.
+
+        The stats are written in the same node order as the tree. The search
+        index paths, or a fresh one when one was saved next to path before, is
+        written to path.paths so it never lags behind the tree.
+        """
+        from .storage import save_tree
+
+        order = save_tree(self.tree.root, path)
+        with open(f"{path}.stat", "wb") as f:
+            for node in order:
+                if isinstance(node, Chunk):
+                    f.write(self.STAT.pack(2, 0, node.size, 0, unhexlify(node.digest)))
+                elif node.is_file:
+                    f.write(self.STAT.pack(1, *node.stat, unhexlify(node.digest)))
+                else:
+                    f.write(self.STAT.pack(0, 0, 0, 0, b""))
+
+        if paths is None and os.path.exists(f"{path}.paths"):
+            paths = self.search_index()
+        if paths is not None:
+            paths.save(f"{path}.paths")
+
+    def load(self, path: str) -> HashTree:
+        """Load a tree saved with `save`, without reading or hashing any file"""
+        from .storage import load_tree
+
+        nodes: list[FSNode] = []
+        rels: list[str] = []
+        with load_tree(path, self.hasher) as mapped, open(f"{path}.stat", "rb") as f:
+            for index, stat in enumerate(self.STAT.iter_unpack(f.read())):
+                kind, ino, size, mtime_ns, digest = stat
+                hid, parent, _, _, offset, length = mapped.record(index)
+                name = os.fsdecode(mapped.read(offset, length))
+                if kind == 2:
+                    node = Chunk.restore(name, hexlify(hid), hexlify(digest))
+                    node.size = size
+                else:
+                    node = FSNode.restore(
+                        name,
+                        hexlify(hid),
+                        hexlify(digest) if kind == 1 else b"",
+                        (ino, size, mtime_ns) if kind == 1 else None,
+                    )
+                if parent < 0:
+                    rels.append("")
+                else:
+                    node._parent = nodes[parent]
+                    nodes[parent].children.append(node)
+                    rels.append(os.path.join(rels[parent], name))
+                nodes.append(node)
+
+        self.tree = HashTree(nodes[0], self.hasher, hashed=True)
+        self.entries = {
+            rel: node for rel, node in zip(rels, nodes) if not isinstance(node, Chunk)
+        }
+        self._index_duplicates()
+        return self.tree
+
+
+def demo():
     R = Node()
     T = HashTree(R)
 
@@ -186,5 +1022,132 @@ def main():
     print(T.invalid_nodes)
 
 
+def print_matches(paths: list[str]):
+    # count first, like look/main.go
+    print(len(paths))
+    if len(paths) < 1000:
+        for path in paths:
+            print(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merkle tree of a directory")
+    parser.add_argument("path", nargs="?", default=None, help="Directory to index")
+    parser.add_argument(
+        "-w", "--workers", type=int, default=None, help="Number of worker threads"
+    )
+    parser.add_argument(
+        "-p", "--processes", action="store_true", help="Hash files in a process pool"
+    )
+    parser.add_argument(
+        "-i", "--index", default=None, help="Saved index to rescan and update"
+    )
+    parser.add_argument(
+        "--duplicates",
+        type=int,
+        nargs="?",
+        const=10,
+        default=None,
+        help="Print the N groups of duplicate files that waste the most space",
+    )
+    parser.add_argument(
+        "-d",
+        "--diff",
+        action="store_true",
+        help="Print what changed since the saved index",
+    )
+    parser.add_argument(
+        "--hash",
+        default="sha256",
+        help="hashlib algorithm for node hids, e.g. sha256 or blake2b",
+    )
+    parser.add_argument(
+        "--digest-size",
+        type=int,
+        default=None,
+        help="Digest size in bytes for blake2b/blake2s",
+    )
+    parser.add_argument(
+        "-s",
+        "--search",
+        default=None,
+        help="Print the indexed files containing SEARCH, "
+        "or matching it if it is a glob. "
+        "Without a path the search index saved next to --index is used",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep the tree up to date with inotify and print the root hash "
+        "after every change",
+    )
+    args = parser.parse_args()
+
+    if args.path is None:
+        if args.search is not None and args.index:
+            from .search import PathIndex
+
+            paths = PathIndex.load(f"{args.index}.paths")
+            print_matches(paths.query(args.search))
+            paths.close()
+        else:
+            demo()
+        return
+
+    hasher = Hasher(args.hash, args.digest_size, args.workers)
+    index = FSIndex(
+        args.path, workers=args.workers, processes=args.processes, hasher=hasher
+    )
+    loaded = False
+    if args.index and os.path.exists(args.index):
+        try:
+            index.load(args.index)
+            loaded = True
+        except ValueError as e:
+            print(f"{e}, rebuilding", file=sys.stderr)
+    if loaded:
+        tree = index.rescan()
+        if args.diff:
+            for change in tree.diff(args.index):
+                path = (
+                    os.path.join(*map(os.fsdecode, change.path)) if change.path else "."
+                )
+                print(f"{change.kind}: {path}")
+    else:
+        tree = index.build()
+    paths = index.search_index() if args.search is not None else None
+    if args.index:
+        index.save(args.index, paths)
+    print(index.stats)
+
+    if args.duplicates is not None:
+        dedup = index.dedup
+        print(
+            f"{dedup.duplicate_files} duplicate files, "
+            f"{dedup.reclaimable} reclaimable bytes"
+        )
+        for group, _ in zip(dedup.duplicates(), range(args.duplicates)):
+            print(f"{group.reclaimable:>12} {group.size:>12} {', '.join(group.paths)}")
+    print(tree.root.hid.decode())
+
+    if paths is not None:
+        print_matches(paths.query(args.search))
+
+    if args.watch:
+        from .watch import Watcher
+
+        watcher = Watcher(index)
+        try:
+            watcher.run(
+                lambda index: print(index.stats, index.tree.root.hid.decode(), sep="\n")
+            )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+            if args.index:
+                index.save(args.index)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,315 @@
+"""Benchmarks for the hash tree implementations.
+
+Run with `python -m hash_fs.bench`. Compares the HashTree in this package,
+the networkx one in `ogosh` and the one in `sandbox/hash_fs.py` on the same
+synthetic trees: node i hangs under node (i - 1) // fanout, so the fan-out
+sets the depth, and node data is drawn from a seeded generator so every run
+builds the same trees.
+
+For each implementation, size and fan-out it records the build time, the
+peak memory traced while building, the latency of changing one leaf and the
+latency of invalidating a leaf and listing the invalid nodes. Results are
+printed (or written) as JSON; with --baseline the run is compared against an
+earlier result file and exits non-zero if anything got slower than the
+tolerance allows.
+"""
+
+import argparse
+import gc
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+from .__main__ import HashTree, Node
+
+SANDBOX = Path(__file__).resolve().parents[4] / "sandbox" / "hash_fs.py"
+
+SIZES = [10**3, 10**4, 10**5, 10**6]
+FANOUTS = [2, 16, 256]
+
+# metrics compared against a baseline, lower is better
+METRICS = ["build_s", "peak_bytes", "update_us.median", "invalidate_us.median"]
+
+
+def generate(n: int, fanout: int, seed: int) -> tuple[list[int], list[bytes]]:
+    """Parent index and data of every node, node 0 is the root"""
+    rng = random.Random(seed)
+    parents = [-1] + [(i - 1) // fanout for i in range(1, n)]
+    data = [b"%x" % rng.getrandbits(64) for _ in range(n)]
+    return parents, data
+
+
+def depth(n: int, fanout: int) -> int:
+    depth, i = 0, n - 1
+    while i > 0:
+        i = (i - 1) // fanout
+        depth += 1
+    return depth
+
+
+class HashFS:
+    name = "hash_fs"
+
+    def build(self, parents: list[int], data: list[bytes]):
+        nodes = [Node(data[0])]
+        tree = HashTree(nodes[0])
+        with tree.batch():
+            for parent, d in zip(parents[1:], data[1:]):
+                node = Node(d)
+                tree.append_to(nodes[parent], node)
+                nodes.append(node)
+        tree.initialize_cache()
+        self.tree, self.nodes = tree, nodes
+
+    def update(self, i: int, data: bytes):
+        node = self.nodes[i]
+        node._data = data
+        self.tree.update_ancestry(node)
+
+    def invalidate(self, i: int) -> int:
+        self.tree.invalidate_ancestry(self.nodes[i])
+        return len(self.tree.invalid_nodes)
+
+    def restore(self, i: int):
+        self.tree.update_ancestry(self.nodes[i])
+
+
+class Ogosh(HashFS):
+    name = "ogosh"
+
+    def __init__(self):
+        from . import ogosh
+
+        self.module = ogosh
+
+    def update(self, i: int, data: bytes):
+        self.nodes[i].data = data
+
+    def build(self, parents: list[int], data: list[bytes]):
+        nodes = [self.module.Node(data[0])]
+        tree = self.module.HashTree(nodes[0])
+        with tree.batch():
+            for parent, d in zip(parents[1:], data[1:]):
+                node = self.module.Node(d)
+                tree.append_to(nodes[parent], node)
+                nodes.append(node)
+        self.tree, self.nodes = tree, nodes
+
+
+class Sandbox(HashFS):
+    """Rehashes the path to the root on every change, has no invalidation tracking"""
+
+    name = "sandbox"
+
+    def __init__(self, path: Path = SANDBOX):
+        spec = importlib.util.spec_from_file_location("sandbox_hash_fs", path)
+        self.module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.module)
+
+    def build(self, parents: list[int], data: list[bytes]):
+        children: list[list[int]] = [[] for _ in parents]
+        for i, parent in enumerate(parents[1:], 1):
+            children[parent].append(i)
+        nodes = [None] * len(parents)
+        for i in reversed(range(len(parents))):
+            node = nodes[i] = self.module.Node(data[i], [nodes[c] for c in children[i]])
+            for child in node.children:
+                child._parent = node
+        self.tree, self.nodes = self.module.HashTree(nodes[0]), nodes
+
+    def update(self, i: int, data: bytes):
+        self.nodes[i].data = data
+
+    invalidate = None
+
+
+IMPLEMENTATIONS = {"hash_fs": HashFS, "ogosh": Ogosh, "sandbox": Sandbox}
+
+
+def percentiles(samples: list[int]) -> dict[str, float]:
+    """Median, p99 and mean of nanosecond samples, in microseconds"""
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, math.ceil(len(samples) * 0.99) - 1)]
+    return {
+        "median": samples[len(samples) // 2] / 1e3,
+        "p99": p99 / 1e3,
+        "mean": sum(samples) / len(samples) / 1e3,
+    }
+
+
+def run(
+    impl: HashFS, n: int, fanout: int, seed: int, samples: int, memory: bool
+) -> dict:
+    parents, data = generate(n, fanout, seed)
+    rng = random.Random(seed + 1)
+    leaves = range((n - 2) // fanout + 1, n) if n > 1 else range(1)
+    result = {
+        "impl": impl.name,
+        "nodes": n,
+        "fanout": fanout,
+        "depth": depth(n, fanout),
+    }
+
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        impl.build(parents, data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        impl.tree = impl.nodes = None
+        gc.collect()
+
+    start = time.perf_counter()
+    impl.build(parents, data)
+    result["build_s"] = time.perf_counter() - start
+    result["peak_bytes"] = peak
+
+    updates = []
+    for k in range(samples):
+        i = rng.choice(leaves)
+        start = time.perf_counter_ns()
+        impl.update(i, b"update %d" % k)
+        updates.append(time.perf_counter_ns() - start)
+    result["update_us"] = percentiles(updates)
+
+    result["invalidate_us"] = result["invalid_nodes"] = None
+    if impl.invalidate is not None:
+        queries = []
+        for _ in range(samples):
+            i = rng.choice(leaves)
+            start = time.perf_counter_ns()
+            invalid = impl.invalidate(i)
+            queries.append(time.perf_counter_ns() - start)
+            impl.restore(i)
+        result["invalidate_us"] = percentiles(queries)
+        result["invalid_nodes"] = invalid
+
+    impl.tree = impl.nodes = None
+    gc.collect()
+    return result
+
+
+def _metric(result: dict, metric: str):
+    value = result
+    for key in metric.split("."):
+        if value is None:
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """Describe every metric that is more than tolerance worse than in baseline"""
+    before = {(r["impl"], r["nodes"], r["fanout"]): r for r in baseline}
+    regressions = []
+    for result in results:
+        old = before.get((result["impl"], result["nodes"], result["fanout"]))
+        if old is None:
+            continue
+        for metric in METRICS:
+            new_value, old_value = _metric(result, metric), _metric(old, metric)
+            if new_value and old_value and new_value > old_value * (1 + tolerance):
+                regressions.append(
+                    f"{result['impl']} n={result['nodes']} fanout={result['fanout']} "
+                    f"{metric}: {old_value:.4g} -> {new_value:.4g}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hash tree implementations"
+    )
+    parser.add_argument(
+        "--impl",
+        nargs="+",
+        choices=list(IMPLEMENTATIONS),
+        default=list(IMPLEMENTATIONS),
+    )
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=SIZES, help="Node counts"
+    )
+    parser.add_argument(
+        "--fanouts", nargs="+", type=int, default=FANOUTS, help="Children per node"
+    )
+    parser.add_argument(
+        "--samples", type=int, default=100, help="Updates and queries per tree"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="Skip the traced build used for peak memory",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default=None,
+        help="Write the JSON results here instead of stdout",
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="Earlier results to check for regressions"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown against the baseline",
+    )
+    args = parser.parse_args()
+
+    results, skipped = [], {}
+    for name in args.impl:
+        try:
+            impl = IMPLEMENTATIONS[name]()
+        except (ImportError, OSError) as e:
+            skipped[name] = str(e)
+            continue
+        for n in args.sizes:
+            for fanout in args.fanouts:
+                result = run(
+                    impl, n, fanout, args.seed, args.samples, not args.no_memory
+                )
+                results.append(result)
+                print(
+                    f"{name:>8} n={n:<8} fanout={fanout:<4} "
+                    f"build {result['build_s']:.3f}s "
+                    f"update {result['update_us']['median']:.1f}us",
+                    file=sys.stderr,
+                )
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "seed": args.seed,
+        "samples": args.samples,
+        "skipped": skipped,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""Content-defined chunking for large files.
+
+A cut point only depends on the bytes right before it, so inserting or
+deleting bytes in the middle of a file only moves the cut points around the
+edit and every other chunk keeps its digest.
+
+A per-byte rolling hash is far too slow in pure Python, so cut points are
+found in two stages that mostly run in C:
+
+1. Every byte is mapped to a marked/unmarked flag with `bytes.translate` and
+   `bytes.find` looks for an unmarked byte followed by RUN marked bytes.
+2. Each candidate is accepted when the crc32 of the WINDOW bytes ending at
+   it has its low mask bits clear, which tunes the average chunk size.
+
+Chunks are clamped to [min_size, max_size] and files are streamed through a
+buffer of at most max_size + read_size bytes.
+"""
+
+import math
+from hashlib import sha256
+from typing import BinaryIO, Iterator
+from zlib import crc32
+
+RUN = 6
+WINDOW = 32
+
+# Half of all byte values, picked from a fixed hash so cut points are stable
+MARKED = bytes(b for b in range(256) if sha256(bytes([b])).digest()[0] & 1)
+TABLE = bytes(1 if b in MARKED else 0 for b in range(256))
+PATTERN = b"\x00" + b"\x01" * RUN
+
+
+class Chunker:
+    def __init__(
+        self,
+        avg_size: int = 1 << 20,
+        min_size: int = None,
+        max_size: int = None,
+        read_size: int = 1 << 20,
+    ):
+        self.avg_size = avg_size
+        self.min_size = max(min_size or avg_size // 4, WINDOW)
+        self.max_size = max_size or avg_size * 4
+        self.read_size = read_size
+
+        # candidates show up about once every 2 ** (RUN + 1) bytes of random data
+        bits = round(math.log2(max(avg_size - self.min_size, 1))) - (RUN + 1)
+        self.mask = (1 << max(bits, 0)) - 1
+
+    def _cut(self, buf: bytearray, marks: bytearray) -> int:
+        limit = min(len(buf), self.max_size)
+        if limit <= self.min_size:
+            return limit
+
+        view = memoryview(buf)
+        start = self.min_size - len(PATTERN)
+        while (i := marks.find(PATTERN, start, limit)) >= 0:
+            end = i + len(PATTERN)
+            if not crc32(view[end - WINDOW : end]) & self.mask:
+                return end
+            start = i + 1
+        return limit
+
+    def split(self, f: BinaryIO) -> Iterator[bytes]:
+        """Yield the chunks of the stream f"""
+        buf = bytearray()
+        marks = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                block = f.read(self.read_size)
+                if not block:
+                    eof = True
+                    break
+                buf += block
+                marks += block.translate(TABLE)
+            if not buf:
+                return
+
+            cut = self._cut(buf, marks)
+            yield bytes(buf[:cut])
+            del buf[:cut]
+            del marks[:cut]
+
+
+def chunk_file(
+    path: str, chunker: Chunker
+) -> tuple[bytes, int, list[tuple[bytes, int]]]:
+    """Digest and size of the file at path and the (digest, size) of its chunks"""
+    sha = sha256()
+    size = 0
+    chunks = []
+    with open(path, "rb", buffering=0) as f:
+        for chunk in chunker.split(f):
+            sha.update(chunk)
+            size += len(chunk)
+            chunks.append((sha256(chunk).hexdigest().encode(), len(chunk)))
+    return sha.hexdigest().encode(), size, chunks
@@ -0,0 +1,263 @@
+"""Array-backed hash tree.
+
+Instead of one Python object per node, `CompactTree` keeps every field in a
+contiguous array indexed by node number:
+
+    digests        32-byte raw sha256 digests, back to back in one bytearray
+    parents        parent index, -1 for the root
+    first_child    first child index, -1 for leaves
+    last_child     last child index, so appending a child is O(1)
+    next_sibling   next sibling index, -1 for the last child
+    data           payloads packed into one bytearray, addressed by offset/length
+
+Nodes are handed out as `NodeView`s, which only hold the tree and an index.
+Payloads that are replaced by longer ones leave their old bytes behind in
+the blob until `compact` repacks it, which happens once they add up to half
+of it.
+Digests are raw bytes rather than hex, so parents hash half as many bytes.
+"""
+
+from array import array
+from binascii import hexlify
+from collections import deque
+from contextlib import contextmanager
+from hashlib import sha256
+
+DIGEST_SIZE = 32
+
+
+class NodeView:
+    """Node-like view of one entry in a CompactTree"""
+
+    __slots__ = ("tree", "index")
+
+    def __init__(self, tree: "CompactTree", index: int):
+        self.tree = tree
+        self.index = index
+
+    @property
+    def digest(self) -> bytes:
+        return self.tree.digest(self.index)
+
+    @property
+    def hid(self) -> bytes:
+        return hexlify(self.digest)
+
+    @property
+    def data(self) -> bytes:
+        return self.tree.get_data(self.index)
+
+    @data.setter
+    def data(self, data: bytes):
+        self.tree.set_data(self.index, data)
+
+    @property
+    def parent(self):
+        parent = self.tree.parents[self.index]
+        return None if parent < 0 else NodeView(self.tree, parent)
+
+    @property
+    def children(self):
+        return [
+            NodeView(self.tree, child) for child in self.tree.child_indexes(self.index)
+        ]
+
+    def add_child(self, data: bytes = b"") -> "NodeView":
+        return self.tree.append_to(self, data)
+
+    def get_root_path(self, node: "NodeView" = None):
+        """Get the path from node to root"""
+        node = node or self
+        while node:
+            yield node
+            node = node.parent
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, NodeView)
+            and self.tree is other.tree
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    def __str__(self):
+        return f"{self.hid}: {self.data}"
+
+    def __repr__(self):
+        return f"CN({self.data})"
+
+
+class CompactTree:
+    """Hash tree stored as a struct of arrays.
+
+    Same hashing scheme as `Node` (the digest of the data followed by the
+    digests of the children) but with raw digests. Each node costs roughly
+    60 bytes plus its payload.
+    """
+
+    def __init__(self, data: bytes = b""):
+        self.digests = bytearray()
+        self.parents = array("i")
+        self.first_child = array("i")
+        self.last_child = array("i")
+        self.next_sibling = array("i")
+        self.offsets = array("Q")
+        self.lengths = array("I")
+        self.blob = bytearray()
+        # bytes of the blob no payload uses any more
+        self._garbage = 0
+
+        self._batch_depth = 0
+        self._deferred: set[int] = set()
+
+        self._new(-1, data)
+        self._rehash(0)
+
+    def __len__(self):
+        return len(self.parents)
+
+    @property
+    def root(self) -> NodeView:
+        return NodeView(self, 0)
+
+    def node(self, index: int) -> NodeView:
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return NodeView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield NodeView(self, index)
+
+    def digest(self, index: int) -> bytes:
+        start = index * DIGEST_SIZE
+        return bytes(self.digests[start : start + DIGEST_SIZE])
+
+    def get_data(self, index: int) -> bytes:
+        start = self.offsets[index]
+        return bytes(self.blob[start : start + self.lengths[index]])
+
+    def set_data(self, index: int, data: bytes):
+        """Replace the payload of index, in place when it fits or is last"""
+        start, length = self.offsets[index], self.lengths[index]
+        if len(data) <= length:
+            self.blob[start : start + len(data)] = data
+            self._garbage += length - len(data)
+        elif start + length == len(self.blob):
+            self.blob[start:] = data
+        else:
+            self.offsets[index] = len(self.blob)
+            self.blob += data
+            self._garbage += length
+        self.lengths[index] = len(data)
+        if self._garbage > len(self.blob) // 2:
+            self.compact()
+        self.update(index)
+
+    def compact(self):
+        """Repack the payloads back to back, dropping the bytes of replaced ones"""
+        blob = bytearray()
+        for index in range(len(self)):
+            start = self.offsets[index]
+            self.offsets[index] = len(blob)
+            blob += self.blob[start : start + self.lengths[index]]
+        self.blob = blob
+        self._garbage = 0
+
+    def child_indexes(self, index: int):
+        child = self.first_child[index]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+
+    def _new(self, parent: int, data: bytes) -> int:
+        index = len(self.parents)
+        self.digests += bytes(DIGEST_SIZE)
+        self.parents.append(parent)
+        self.first_child.append(-1)
+        self.last_child.append(-1)
+        self.next_sibling.append(-1)
+        self.offsets.append(len(self.blob))
+        self.lengths.append(len(data))
+        self.blob += data
+
+        if parent >= 0:
+            last = self.last_child[parent]
+            if last < 0:
+                self.first_child[parent] = index
+            else:
+                self.next_sibling[last] = index
+            self.last_child[parent] = index
+        return index
+
+    def append_to(self, parent: NodeView, data: bytes = b"") -> NodeView:
+        """Add a new child with data under parent"""
+        index = self._new(parent.index, data)
+        self.update(index)
+        return NodeView(self, index)
+
+    def _rehash(self, index: int):
+        start = self.offsets[index]
+        sha = sha256(self.blob[start : start + self.lengths[index]]).digest()
+        if self.first_child[index] >= 0:
+            digests = memoryview(self.digests)
+            h = sha256(sha)
+            for child in self.child_indexes(index):
+                h.update(digests[child * DIGEST_SIZE : (child + 1) * DIGEST_SIZE])
+            sha = h.digest()
+        start = index * DIGEST_SIZE
+        self.digests[start : start + DIGEST_SIZE] = sha
+
+    def update(self, index: int):
+        """Rehash the path from index to root, or defer it inside a batch"""
+        if self._batch_depth:
+            self._deferred.add(index)
+            return
+        while index >= 0:
+            self._rehash(index)
+            index = self.parents[index]
+
+    @contextmanager
+    def batch(self):
+        """Defer rehashing until the outermost batch exits, like `HashTree.batch`"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.commit()
+
+    def commit(self) -> int:
+        """Rehash every node on the deferred paths once, deepest first"""
+        deferred, self._deferred = self._deferred, set()
+        depths: dict[int, int] = {}
+        for index in deferred:
+            path = []
+            while index >= 0 and index not in depths:
+                path.append(index)
+                index = self.parents[index]
+            depth = -1 if index < 0 else depths[index]
+            for index in reversed(path):
+                depth += 1
+                depths[index] = depth
+
+        for index in sorted(depths, key=depths.get, reverse=True):
+            self._rehash(index)
+        return len(depths)
+
+    @classmethod
+    def from_node(cls, root) -> "CompactTree":
+        """Copy a tree of `Node`s, hashing every node exactly once"""
+        tree = cls(bytes(root.data))
+        queue = deque([(root, 0)])
+        with tree.batch():
+            while queue:
+                node, index = queue.popleft()
+                for child in node.children:
+                    child_index = tree._new(index, bytes(child.data))
+                    tree._deferred.add(child_index)
+                    queue.append((child, child_index))
+        return tree
@@ -0,0 +1,88 @@
+"""Content-addressed duplicate index over file digests.
+
+Maps every content digest to the paths that share it and keeps the number of
+duplicate files and reclaimable bytes up to date on every add/discard, so the
+totals are O(1) and listing duplicates only touches digests that have more
+than one path. Nothing is ever re-hashed, the digests come from the tree.
+
+Most digests belong to a single file, so a lone path is stored as a plain
+string and only upgraded to a set once a second copy shows up.
+"""
+
+from typing import Iterator, NamedTuple
+
+
+class Duplicates(NamedTuple):
+    digest: bytes
+    size: int
+    paths: list[str]
+
+    @property
+    def reclaimable(self) -> int:
+        return self.size * (len(self.paths) - 1)
+
+
+class DedupIndex:
+    def __init__(self):
+        self._paths: dict[bytes, str | set[str]] = {}
+        self._sizes: dict[bytes, int] = {}
+        self._duplicated: set[bytes] = set()
+        self.duplicate_files = 0
+        self.reclaimable = 0
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, digest: bytes):
+        return digest in self._paths
+
+    def paths(self, digest: bytes) -> list[str]:
+        paths = self._paths.get(digest)
+        if paths is None:
+            return []
+        return [paths] if isinstance(paths, str) else sorted(paths)
+
+    def add(self, path: str, digest: bytes, size: int):
+        paths = self._paths.get(digest)
+        if paths is None:
+            self._paths[digest] = path
+            self._sizes[digest] = size
+            return
+        if isinstance(paths, str):
+            if paths == path:
+                return
+            paths = self._paths[digest] = {paths}
+            self._duplicated.add(digest)
+        elif path in paths:
+            return
+        paths.add(path)
+        self.duplicate_files += 1
+        self.reclaimable += self._sizes[digest]
+
+    def discard(self, path: str, digest: bytes):
+        paths = self._paths.get(digest)
+        if paths is None:
+            return
+        if isinstance(paths, str):
+            if paths == path:
+                del self._paths[digest]
+                del self._sizes[digest]
+            return
+        if path not in paths:
+            return
+        paths.remove(path)
+        self.duplicate_files -= 1
+        self.reclaimable -= self._sizes[digest]
+        if len(paths) == 1:
+            self._paths[digest] = paths.pop()
+            self._duplicated.discard(digest)
+
+    def duplicates(self, min_size: int = 0) -> Iterator[Duplicates]:
+        """Yield every group of identical files, largest reclaimable first"""
+        groups = [
+            Duplicates(digest, self._sizes[digest], sorted(self._paths[digest]))
+            for digest in self._duplicated
+            if self._sizes[digest] >= min_size
+        ]
+        groups.sort(key=lambda group: group.reclaimable, reverse=True)
+        yield from groups
@@ -0,0 +1,121 @@
+"""Top-down Merkle diff between two hash trees.
+
+Both trees are walked from the root together and any pair of subtrees with
+the same hid is skipped without being looked at, so the cost is proportional
+to the changed paths (times the fan-out of the directories on them), not to
+the size of the trees. Either side can be a saved tree, in which case only
+the nodes on changed paths are ever read from disk.
+"""
+
+import mmap
+import os
+from contextlib import ExitStack
+from typing import Callable, Iterator, NamedTuple
+
+from .__main__ import FSIndex, Node
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+
+
+class Change(NamedTuple):
+    kind: str
+    path: tuple
+    old: Node | None
+    new: Node | None
+
+
+def node_key(node: Node):
+    """Children are matched by their data, which is the entry name for FSNodes"""
+    return bytes(node.data)
+
+
+class _Files:
+    """Tells FSIndex files apart, their content chunks below them aren't entries.
+
+    Live FSNode files have a stat. The nodes of a saved FSIndex don't, their
+    kind is looked up in the `.stat` sidecar saved next to the tree.
+    """
+
+    def __init__(self, mappings: ExitStack):
+        self._mappings = mappings
+        self._sidecars: dict[int, mmap.mmap] = {}
+
+    def root(self, tree) -> Node:
+        if hasattr(tree, "root"):
+            return tree.root
+        if isinstance(tree, str):
+            from .storage import load_tree
+
+            nodes = self._mappings.enter_context(load_tree(tree))
+            sidecar = f"{tree}.stat"
+            if os.path.exists(sidecar) and os.path.getsize(sidecar):
+                with open(sidecar, "rb") as f:
+                    stats = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._sidecars[id(nodes)] = self._mappings.enter_context(stats)
+            return nodes[0]
+        return tree
+
+    def __call__(self, node: Node) -> bool:
+        if getattr(node, "stat", None) is not None:
+            return True
+        stats = self._sidecars.get(id(getattr(node, "_nodes", None)))
+        return stats is not None and stats[node.index * FSIndex.STAT.size] == 1
+
+
+def _group(children: list[Node], key: Callable) -> dict:
+    groups: dict = {}
+    for child in children:
+        groups.setdefault(key(child), []).append(child)
+    return groups
+
+
+def diff(old, new, key: Callable = node_key) -> Iterator[Change]:
+    """Yield the changes that turn old into new.
+
+    old and new may be HashTrees, root Nodes or paths of saved trees. Added and
+    removed subtrees are reported once, at their top. A node present on both
+    sides is reported as modified when it is a leaf on either side or its own
+    data changed; directories that only differ below are just descended into.
+    Files of an FSIndex tree count as leaves even when they are chunked.
+    Siblings sharing a key are paired in order.
+
+    Saved trees are unmapped once the diff is exhausted or closed, so their
+    nodes in the changes are only readable while iterating.
+    """
+    with ExitStack() as mappings:
+        is_file = _Files(mappings)
+        yield from _diff(is_file.root(old), is_file.root(new), key, is_file)
+
+
+def _diff(old: Node, new: Node, key: Callable, is_file: Callable) -> Iterator[Change]:
+    stack = [((), old, new)]
+    while stack:
+        path, a, b = stack.pop()
+        if a.hid == b.hid:
+            continue
+
+        if is_file(a) or is_file(b):
+            yield Change(MODIFIED, path, a, b)
+            continue
+
+        a_children, b_children = a.children, b.children
+        if not a_children or not b_children or a.data != b.data:
+            yield Change(MODIFIED, path, a, b)
+        if not a_children and not b_children:
+            continue
+
+        a_groups = _group(a_children, key)
+        b_groups = _group(b_children, key)
+        for k, olds in a_groups.items():
+            news = b_groups.get(k, [])
+            for i, child in enumerate(olds):
+                if i < len(news):
+                    stack.append((path + (k,), child, news[i]))
+                else:
+                    yield Change(REMOVED, path + (k,), child, None)
+        for k, news in b_groups.items():
+            olds = a_groups.get(k, [])
+            for child in news[len(olds) :]:
+                yield Change(ADDED, path + (k,), None, child)
@@ -0,0 +1,105 @@
+"""Pluggable hashing for node hids.
+
+A `Hasher` wraps one of the hashlib algorithms and hands out hex digests,
+the form hids are kept in. blake2b and blake2s take a digest size, the other
+algorithms have a fixed one; variable-length XOFs like shake_128 are refused.
+
+A hasher only hashes node data and joined child hids. File contents keep
+their sha256 content digest, which the dedup index, the .stat sidecar and
+syncope's wire format depend on, and are hashed by FSIndex's own pools.
+
+hashlib releases the GIL while it hashes buffers of at least 2 KiB, so
+`digest_many` sends buffers above `threshold` to a thread pool and hashes
+the small ones on the calling thread while the pool works; a thread per
+tiny buffer would only add overhead. `HashTree.commit` hashes every level of
+a rebuilt tree with one `digest_many` call per level, which only pays off for
+trees holding large data in their nodes. FSIndex nodes hold names and
+digests, so they are hashed inline.
+"""
+
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# smallest buffer hashlib hashes without the GIL
+GIL_RELEASE = 2048
+
+VARIABLE_SIZE = {"blake2b": 64, "blake2s": 32}
+
+
+class Hasher:
+    def __init__(
+        self,
+        algorithm: str = "sha256",
+        digest_size: int = None,
+        workers: int = None,
+        threshold: int = 1 << 16,
+    ):
+        if algorithm in VARIABLE_SIZE:
+            if (
+                digest_size is not None
+                and not 1 <= digest_size <= VARIABLE_SIZE[algorithm]
+            ):
+                raise ValueError(
+                    f"{algorithm} digests are 1 to {VARIABLE_SIZE[algorithm]} bytes"
+                )
+            self._new = partial(
+                getattr(hashlib, algorithm),
+                digest_size=digest_size or VARIABLE_SIZE[algorithm],
+            )
+        else:
+            if algorithm not in hashlib.algorithms_available:
+                raise ValueError(f"unknown hash algorithm {algorithm!r}")
+            self._new = partial(hashlib.new, algorithm)
+            if not self._new().digest_size:
+                raise ValueError(f"{algorithm} has no fixed digest size")
+            if digest_size is not None and digest_size != self._new().digest_size:
+                raise ValueError(
+                    f"{algorithm} digests are always {self._new().digest_size} bytes"
+                )
+
+        self.algorithm = algorithm
+        self.digest_size = self._new().digest_size
+        self.workers = workers or os.cpu_count()
+        self.threshold = max(threshold, GIL_RELEASE)
+        self._pool: ThreadPoolExecutor = None
+
+    def __repr__(self):
+        return f"Hasher({self.algorithm!r}, digest_size={self.digest_size})"
+
+    def digest(self, data) -> bytes:
+        return self._new(data).hexdigest().encode()
+
+    def hasher(self):
+        """A new incremental hash object"""
+        return self._new()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="hasher")
+        return self._pool
+
+    def digest_many(self, buffers: list) -> list[bytes]:
+        """Digest every buffer, large ones in parallel"""
+        large = [i for i, data in enumerate(buffers) if len(data) >= self.threshold]
+        if len(large) < 2 or self.workers < 2:
+            return [self.digest(data) for data in buffers]
+
+        futures = {i: self.pool.submit(self.digest, buffers[i]) for i in large}
+        digests = [
+            None if i in futures else self.digest(data)
+            for i, data in enumerate(buffers)
+        ]
+        for i, future in futures.items():
+            digests[i] = future.result()
+        return digests
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+DEFAULT = Hasher()
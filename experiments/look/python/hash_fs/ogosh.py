@@ -1,4 +1,5 @@
 import networkx as nx
+from contextlib import contextmanager
 from hashlib import sha256
 from typing import Any
 
@@ -6,6 +7,7 @@ from typing import Any
 class Node:
     def __init__(self, data=b""):
         self._data: Any = data
+        self._tree: "HashTree | None" = None
         self.hid = self.__hash__()
 
     @property
@@ -15,7 +17,10 @@ class Node:
     @data.setter
     def data(self, data):
         self._data = data
-        self.hid = self.__hash__()
+        if self._tree is None:
+            self.hid = self.__hash__()
+        else:
+            self._tree.update_ancestry(self)
 
     def __hash__(self) -> bytes:
         sha = sha256(self._data).hexdigest().encode()
@@ -26,38 +31,133 @@ class Node:
 
 
 class HashTree:
+    """Merkle DAG on a networkx graph.
+
+    Graph nodes are keyed by hid and a hid covers a node's data and the hids
+    of its children, so identical subtrees are stored once in the graph no
+    matter how many Nodes share them. Each graph node keeps its data and its
+    ordered child hids and lives as long as some Node still hashes to it.
+
+    Nodes are linked through a parent index instead of graph queries, so the
+    ancestry of a node is a walk up to the root. Changes only mark nodes
+    dirty; `commit` rehashes every dirty node and its ancestors once, deepest
+    first, which is a topological order of the affected part of the tree.
+    """
+
     def __init__(self, root: Node):
         self.graph = nx.DiGraph()
-        self.graph.add_node(root.hid, node=root)
         self.root = root
+        self.parents: dict[int, Node] = {}
+        self.children: dict[int, list[Node]] = {id(root): []}
+        self.stored: dict[int, bytes] = {}
+        self.refs: dict[bytes, int] = {}
+        self.dirty: dict[int, Node] = {}
+        self._batch_depth = 0
+
+        root._tree = self
+        self.update_ancestry(root)
 
     def append_to(self, parent: Node, child: Node):
-        if child.hid not in self.graph:
-            self.graph.add_node(child.hid, node=child)
-        self.graph.add_edge(parent.hid, child.hid)
-        child.hid = child.__hash__()
+        if id(parent) not in self.children:
+            raise ValueError(f"{parent} is not in the tree")
+        if child._tree is not None:
+            raise ValueError(f"{child} already belongs to a tree")
+        child._tree = self
+        self.parents[id(child)] = parent
+        self.children[id(child)] = []
+        self.children[id(parent)].append(child)
+        self.update_ancestry(child)
+
+    def ancestors(self, node: Node) -> list[Node]:
+        """Ancestors of node, nearest first"""
+        ancestors = []
+        while (node := self.parents.get(id(node))) is not None:
+            ancestors.append(node)
+        return ancestors
 
-    def ancestors(self, node: Node):
-        return nx.ancestors(self.graph, node.hid)
+    @property
+    def batching(self):
+        return self._batch_depth > 0
+
+    @contextmanager
+    def batch(self):
+        """Defer rehashing until the outermost batch exits"""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.commit()
+
+    def _pending(self) -> dict[int, tuple[int, Node]]:
+        """Depth and node of every dirty node and its ancestors"""
+        depths: dict[int, tuple[int, Node]] = {}
+        for node in self.dirty.values():
+            path = []
+            while node is not None and id(node) not in depths:
+                path.append(node)
+                node = self.parents.get(id(node))
+            depth = -1 if node is None else depths[id(node)][0]
+            for node in reversed(path):
+                depth += 1
+                depths[id(node)] = (depth, node)
+        return depths
+
+    def _store(self, hid: bytes, node: Node, children: list[bytes]):
+        if hid not in self.graph:
+            self.graph.add_node(hid, data=node.data, children=children)
+            self.graph.add_edges_from((hid, child) for child in children)
+        self.refs[hid] = self.refs.get(hid, 0) + 1
+
+    def _release(self, hid: bytes):
+        self.refs[hid] -= 1
+        if not self.refs[hid]:
+            del self.refs[hid]
+            self.graph.remove_node(hid)
+
+    def commit(self) -> int:
+        """Rehash the dirty nodes and their ancestors once, deepest first.
+
+        Returns the number of rehashed nodes.
+        """
+        depths = self._pending()
+        self.dirty.clear()
+        for _, node in sorted(depths.values(), key=lambda item: item[0], reverse=True):
+            children = [child.hid for child in self.children[id(node)]]
+            own = node.__hash__()
+            hid = (
+                sha256(own + b"".join(children)).hexdigest().encode()
+                if children
+                else own
+            )
+            old = self.stored.get(id(node))
+            if hid != old:
+                self._store(hid, node, children)
+                if old is not None:
+                    self._release(old)
+                self.stored[id(node)] = hid
+            node.hid = hid
+        return len(depths)
 
     def invalidate_ancestry(self, node: Node):
-        for ancestor_hid in self.ancestors(node):
-            ancestor_node = self.graph.nodes[ancestor_hid]["node"]
-            ancestor_node.hid = None
+        self.dirty[id(node)] = node
+        node.hid = None
+        for ancestor in self.ancestors(node):
+            ancestor.hid = None
 
     def update_ancestry(self, node: Node):
-        node.hid = node.__hash__()
-        for ancestor_hid in self.ancestors(node):
-            ancestor_node = self.graph.nodes[ancestor_hid]["node"]
-            ancestor_node.hid = ancestor_node.__hash__()
+        self.dirty[id(node)] = node
+        if not self.batching:
+            self.commit()
+
+    def subtree(self, hid: bytes) -> nx.DiGraph:
+        """The shared subgraph stored under hid"""
+        return self.graph.subgraph(nx.descendants(self.graph, hid) | {hid})
 
     @property
     def invalid_nodes(self):
-        return [
-            hid
-            for hid, data in self.graph.nodes.data()
-            if hid != data["node"].__hash__()
-        ]
+        return [node for _, node in self._pending().values()]
 
 
 def main():
@@ -74,19 +174,24 @@ def main():
     G = Node(b"!")
     H = Node(b"!!")
 
-    T.append_to(R, A)
-    T.append_to(A, B)
-    T.append_to(B, C)
+    with T.batch():
+        T.append_to(R, A)
+        T.append_to(A, B)
+        T.append_to(B, C)
+
+        T.append_to(R, D)
+        T.append_to(D, E)
+        T.append_to(D, F)
+        T.append_to(F, G)
+        T.append_to(F, H)
 
-    T.append_to(R, D)
-    T.append_to(D, E)
-    T.append_to(D, F)
-    T.append_to(F, G)
-    T.append_to(F, H)
+    # C and G are the same leaf, stored once
+    print(len(T.stored), "nodes,", T.graph.number_of_nodes(), "stored")
 
-    # T.invalidate_ancestry(F)
-    # Now you can use any networkx functions on T.graph as required.
+    T.invalidate_ancestry(F)
     print(T.invalid_nodes)
+    F.data = b"Wolf"
+    print(T.invalid_nodes, R.hid)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+"""Merkle inclusion proofs.
+
+Every internal node hashes a list of parts (see `Node.hash_parts`): its own
+data digest, for FSNodes the content digest, then its children's hids. A
+proof for a node records, for each ancestor, the parts hashed before and
+after the one on the path. Checking it against a trusted root is one hash
+per level, without touching the rest of the tree.
+
+A step keeps the other parts as whole digests, along with the position of
+the hid on the path among them, so checking a proof also checks its shape:
+parts that aren't full digests, or a hid standing in for the data digest,
+don't lead to the root. Parts are hex digests, so proofs are stored as raw
+bytes at half the size.
+"""
+
+import os
+import struct
+from binascii import hexlify, unhexlify
+from hashlib import sha256
+from typing import NamedTuple
+
+from .__main__ import FSNode, Node, hash_file
+from .hashing import DEFAULT, Hasher
+
+# file content digests are always sha256, see `hash_file`
+CONTENT_SIZE = sha256().digest_size
+
+_HEADER = struct.Struct("<?HI")
+_STEP = struct.Struct("<HH")
+_PART = struct.Struct("<H")
+
+
+class Proof(NamedTuple):
+    leaf: bytes
+    # the other parts of every level and the position of the hid among them
+    steps: list[tuple[list[bytes], int]]
+    # leaf is a file's content digest rather than a node hid
+    content: bool = False
+
+    def root(self, leaf: bytes = None, hasher: Hasher = DEFAULT) -> bytes:
+        """Recompute the root hid the proof leads to from leaf, by default its own.
+
+        Raises ValueError when a part isn't a whole digest.
+        """
+        hid = self.leaf if leaf is None else leaf
+        size = 2 * hasher.digest_size
+        if len(hid) != (2 * CONTENT_SIZE if self.content else size):
+            raise ValueError(f"leaf {hid!r} is not a whole digest")
+        for parts, index in self.steps:
+            # parts[0] is the node's data digest, never a child
+            if not 1 <= index <= len(parts):
+                raise ValueError(f"no child at {index} of {len(parts)} parts")
+            joined = parts[:index] + [hid] + parts[index:]
+            for position, part in enumerate(joined):
+                # a file's content digest follows its name digest
+                if len(part) != size and (position, len(part)) != (1, 2 * CONTENT_SIZE):
+                    raise ValueError(f"part {position} is not a whole digest")
+            hid = hasher.digest(b"".join(joined))
+        return hid
+
+    def to_bytes(self) -> bytes:
+        out = [
+            _HEADER.pack(self.content, len(self.leaf) // 2, len(self.steps)),
+            unhexlify(self.leaf),
+        ]
+        for parts, index in self.steps:
+            out.append(_STEP.pack(index, len(parts)))
+            for part in parts:
+                part = unhexlify(part)
+                out += [_PART.pack(len(part)), part]
+        return b"".join(out)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Proof":
+        content, size, count = _HEADER.unpack_from(data, 0)
+        offset = _HEADER.size
+        leaf = hexlify(data[offset : offset + size])
+        offset += size
+        steps = []
+        for _ in range(count):
+            index, n_parts = _STEP.unpack_from(data, offset)
+            offset += _STEP.size
+            parts = []
+            for _ in range(n_parts):
+                (length,) = _PART.unpack_from(data, offset)
+                offset += _PART.size
+                parts.append(hexlify(data[offset : offset + length]))
+                offset += length
+            steps.append((parts, index))
+        return cls(leaf, steps, content)
+
+
+def _step(parts: list[bytes], index: int) -> tuple[list[bytes], int]:
+    """The parts around parts[index], without the empty digest of directories"""
+    before = [part for part in parts[:index] if part]
+    return before + [part for part in parts[index + 1 :] if part], len(before)
+
+
+def _steps_up(node: Node) -> list[tuple[list[bytes], int]]:
+    steps = []
+    while node.parent is not None:
+        parent = node.parent
+        parts = parent.hash_parts()
+        # children are the last parts
+        index = len(parts) - len(parent.children) + parent.children.index(node)
+        steps.append(_step(parts, index))
+        node = parent
+    return steps
+
+
+def prove(node: Node) -> Proof:
+    """Proof that node's hid is part of the tree under its root"""
+    return Proof(node.hid, _steps_up(node))
+
+
+def prove_content(node: FSNode) -> Proof:
+    """Proof that a file with the content digest of node is part of the tree"""
+    return Proof(node.digest, [_step(node.hash_parts(), 1)] + _steps_up(node), True)
+
+
+def verify(
+    proof: Proof, root: bytes, leaf: bytes = None, hasher: Hasher = DEFAULT
+) -> bool:
+    """Check that leaf (defaults to the proven leaf) leads to the trusted root hid"""
+    if leaf is not None and leaf != proof.leaf:
+        return False
+    try:
+        return proof.root(hasher=hasher) == root
+    except ValueError:
+        return False
+
+
+def verify_file(
+    path: str, rel: str, proof: Proof, root: bytes, hasher: Hasher = DEFAULT
+) -> bool:
+    """Check that the file at path is the one at rel under the trusted root.
+
+    The file is hashed against the content proof, and the name digest of
+    every level below the root against the components of rel.
+    """
+    names = [os.fsencode(name) for name in rel.split(os.sep) if name]
+    if not proof.content or len(proof.steps) != len(names) + 1:
+        return False
+    # the file's own level comes first, the root's last
+    for (parts, _), name in zip(proof.steps, reversed(names)):
+        if parts[0] != hasher.digest(name):
+            return False
+    digest, _ = hash_file(path)
+    return verify(proof, root, digest, hasher)
+
+
+def verify_subtree(node: Node) -> list[Node]:
+    """Rehash everything under node from the leaves up.
+
+    Returns the nodes whose stored hid is wrong.
+    """
+    stale = []
+    order = [node]
+    for current in order:
+        order.extend(current.children)
+    computed: dict[int, bytes] = {}
+    for current in reversed(order):
+        shas = current.hash_parts()
+        children = current.children
+        if children:
+            shas[len(shas) - len(children) :] = [computed[id(c)] for c in children]
+        hid = shas[0] if len(shas) == 1 else current.hasher.digest(b"".join(shas))
+        computed[id(current)] = hid
+        if hid != current.hid:
+            stale.append(current)
+    return stale
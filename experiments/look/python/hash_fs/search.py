@@ -0,0 +1,226 @@
+"""Trigram index over the paths of an FSIndex.
+
+Every path is split into its overlapping 3-byte grams and each gram keeps a
+sorted posting list of the ids of the paths containing it. A query only
+looks at the paths in the shortest posting list among the grams of its
+literal text, so it costs about as much as the rarest gram, not the number
+of paths. Queries without a 3-byte literal fall back to a single regex pass
+over all the paths, which still runs in C.
+
+Layout of the saved index (native byte order, every section 8-byte aligned):
+
+    header    magic, version, path count, gram count, postings count
+    offsets   Q[paths + 1]  start of every path in the blob
+    starts    Q[grams + 1]  start of every posting list
+    grams     I[grams]      sorted grams, as big endian 24-bit ints
+    postings  I[postings]   path ids
+    blob      paths, each terminated by a NUL byte
+
+Loading maps the file and only touches the postings and paths a query needs.
+"""
+
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+MAGIC = b"HSPI"
+VERSION = 1
+
+HEADER = struct.Struct("<4sH2xQQQ")
+
+GLOB_CHARS = frozenset("*?[")
+
+
+def _translate(pattern: bytes) -> tuple[bytes, list[bytes]]:
+    """Translate a glob into a regex that can't cross a NUL.
+
+    Also returns the literal runs between the wildcards.
+    """
+    out, literals, literal = [], [], b""
+    i = 0
+    while i < len(pattern):
+        c = pattern[i : i + 1]
+        i += 1
+        if c == b"*":
+            token = b"[^\0]*"
+        elif c == b"?":
+            token = b"[^\0]"
+        elif c == b"[" and (end := pattern.find(b"]", i + 1)) >= 0:
+            body = pattern[i:end].replace(b"\\", b"\\\\")
+            i = end + 1
+            token = (
+                b"[^\0" + body[1:] + b"]"
+                if body.startswith(b"!")
+                else b"[" + body + b"]"
+            )
+        else:
+            out.append(re.escape(c))
+            literal += c
+            continue
+        out.append(token)
+        literals.append(literal)
+        literal = b""
+    literals.append(literal)
+    return b"".join(out), [literal for literal in literals if literal]
+
+
+class PathIndex:
+    def __init__(
+        self, offsets, starts, grams, postings, blob, mapped: mmap.mmap = None
+    ):
+        self.offsets = offsets
+        self.starts = starts
+        self.grams = grams
+        self.postings = postings
+        self.blob = blob
+        self._mapped = mapped
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, id: int) -> str:
+        return os.fsdecode(self._path(id))
+
+    def _path(self, id: int) -> bytes:
+        return bytes(self.blob[self.offsets[id] : self.offsets[id + 1] - 1])
+
+    @classmethod
+    def build(cls, paths) -> "PathIndex":
+        """Index the given paths, they are stored sorted"""
+        encoded = sorted(map(os.fsencode, paths))
+        offsets = array("Q", [0])
+        postings: dict[bytes, array] = {}
+        for id, data in enumerate(encoded):
+            offsets.append(offsets[-1] + len(data) + 1)
+            for gram in {data[i : i + 3] for i in range(len(data) - 2)}:
+                posting = postings.get(gram)
+                if posting is None:
+                    posting = postings[gram] = array("I")
+                posting.append(id)
+
+        starts = array("Q", [0])
+        grams = array("I")
+        flat = array("I")
+        for gram in sorted(postings):
+            grams.append(int.from_bytes(gram, "big"))
+            flat.extend(postings[gram])
+            starts.append(len(flat))
+        blob = b"".join(data + b"\0" for data in encoded)
+        return cls(offsets, starts, grams, flat, blob)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC, VERSION, len(self), len(self.grams), len(self.postings)
+                )
+            )
+            for section in (self.offsets, self.starts, self.grams, self.postings):
+                f.write(section)
+                if len(section) % 2 and section.itemsize == 4:
+                    f.write(b"\0" * 4)
+            f.write(self.blob)
+
+    @classmethod
+    def load(cls, path: str) -> "PathIndex":
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_paths, n_grams, n_postings = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            mapped.close()
+            raise ValueError(f"{path} is not a saved path index")
+
+        view = memoryview(mapped)
+        sections = []
+        offset = HEADER.size
+        for code, count in (
+            ("Q", n_paths + 1),
+            ("Q", n_grams + 1),
+            ("I", n_grams),
+            ("I", n_postings),
+        ):
+            size = struct.calcsize(code) * count
+            sections.append(view[offset : offset + size].cast(code))
+            offset += (size + 7) & ~7
+        return cls(*sections, view[offset:], mapped)
+
+    def close(self):
+        if self._mapped is not None:
+            for section in (
+                self.offsets,
+                self.starts,
+                self.grams,
+                self.postings,
+                self.blob,
+            ):
+                section.release()
+            self._mapped.close()
+            self._mapped = None
+
+    def _posting(self, gram: bytes):
+        key = int.from_bytes(gram, "big")
+        i = bisect_left(self.grams, key)
+        if i == len(self.grams) or self.grams[i] != key:
+            return self.postings[:0]
+        return self.postings[self.starts[i] : self.starts[i + 1]]
+
+    def _candidates(self, literals: list[bytes]):
+        """Shortest posting list among the grams of literals, None without grams"""
+        best = None
+        for literal in literals:
+            for i in range(len(literal) - 2):
+                posting = self._posting(literal[i : i + 3])
+                if best is None or len(posting) < len(best):
+                    best = posting
+                    if not best:
+                        return best
+        return best
+
+    def _scan(self, regex: re.Pattern, limit: int = None) -> list[int]:
+        ids = []
+        pos = 0
+        # an empty match at the end of the blob isn't in any path
+        while pos < len(self.blob) and (match := regex.search(self.blob, pos)):
+            id = bisect_right(self.offsets, match.start()) - 1
+            ids.append(id)
+            if len(ids) == limit:
+                break
+            pos = self.offsets[id + 1]
+        return ids
+
+    def search(self, pattern: str, limit: int = None) -> list[str]:
+        """Paths containing pattern"""
+        needle = os.fsencode(pattern)
+        candidates = self._candidates([needle])
+        if candidates is None:
+            ids = self._scan(re.compile(re.escape(needle)), limit)
+        else:
+            ids = list(
+                islice((id for id in candidates if needle in self._path(id)), limit)
+            )
+        return [self[id] for id in ids]
+
+    def glob(self, pattern: str, limit: int = None) -> list[str]:
+        """Paths matching the glob pattern as a whole, `*` matches `/` as in fnmatch"""
+        body, literals = _translate(os.fsencode(pattern))
+        candidates = self._candidates(literals)
+        if candidates is None:
+            ids = self._scan(re.compile(b"(?<![^\0])" + body + b"(?=\0)"), limit)
+        else:
+            regex = re.compile(body)
+            ids = list(
+                islice(
+                    (id for id in candidates if regex.fullmatch(self._path(id))), limit
+                )
+            )
+        return [self[id] for id in ids]
+
+    def query(self, pattern: str, limit: int = None) -> list[str]:
+        """Glob if pattern has any wildcard, substring search otherwise"""
+        if GLOB_CHARS.intersection(pattern):
+            return self.glob(pattern, limit)
+        return self.search(pattern, limit)
@@ -0,0 +1,268 @@
+"""Persistent maps for HashTree cache histories.
+
+`PersistentMap` is a hash array mapped trie: every branch holds up to 32
+slots selected by 5 bits of the key hash, stored compactly behind a bitmap.
+Updates copy only the branches on the path to the changed key and share
+everything else, so a new version costs O(log32 n) memory.
+
+`SnapshotCache` is the mutable face used as `HashTree.cache`. It mutates
+branches it created itself in place (like a Clojure transient) and hands out
+immutable snapshots in O(1); after a snapshot, further writes copy again.
+"""
+
+from collections.abc import Mapping, MutableMapping
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+HASH_BITS = 64
+HASH_MASK = (1 << HASH_BITS) - 1
+
+_MISSING = object()
+
+
+def _hash(key) -> int:
+    return hash(key) & HASH_MASK
+
+
+class _Branch:
+    __slots__ = ("bitmap", "items", "owner")
+
+    def __init__(self, bitmap: int, items: list, owner):
+        self.bitmap = bitmap
+        self.items = items
+        self.owner = owner
+
+
+class _Collision:
+    """Keys whose full hashes are equal"""
+
+    __slots__ = ("hash", "items", "owner")
+
+    def __init__(self, hash: int, items: list, owner):
+        self.hash = hash
+        self.items = items
+        self.owner = owner
+
+
+_EMPTY = _Branch(0, [], None)
+
+
+def _editable(node, owner):
+    if owner is not None and node.owner is owner:
+        return node
+    if isinstance(node, _Branch):
+        return _Branch(node.bitmap, list(node.items), owner)
+    return _Collision(node.hash, list(node.items), owner)
+
+
+def _get(node, h: int, shift: int, key, default):
+    while True:
+        if isinstance(node, _Collision):
+            for k, v in node.items:
+                if k == key:
+                    return v
+            return default
+        bit = 1 << ((h >> shift) & MASK)
+        if not node.bitmap & bit:
+            return default
+        item = node.items[(node.bitmap & (bit - 1)).bit_count()]
+        if isinstance(item, tuple):
+            return item[1] if item[0] == key else default
+        node = item
+        shift += BITS
+
+
+def _pair(shift: int, h1: int, leaf1: tuple, h2: int, leaf2: tuple, owner):
+    """Smallest subtree holding two leaves with different keys"""
+    if shift >= HASH_BITS or h1 == h2:
+        return _Collision(h1, [leaf1, leaf2], owner)
+    i1, i2 = (h1 >> shift) & MASK, (h2 >> shift) & MASK
+    if i1 == i2:
+        return _Branch(
+            1 << i1, [_pair(shift + BITS, h1, leaf1, h2, leaf2, owner)], owner
+        )
+    items = [leaf1, leaf2] if i1 < i2 else [leaf2, leaf1]
+    return _Branch((1 << i1) | (1 << i2), items, owner)
+
+
+def _set(node, h: int, shift: int, key, value, owner):
+    """Return (new node, whether a key was added)"""
+    if isinstance(node, _Collision):
+        node = _editable(node, owner)
+        for i, (k, _) in enumerate(node.items):
+            if k == key:
+                node.items[i] = (key, value)
+                return node, False
+        node.items.append((key, value))
+        return node, True
+
+    bit = 1 << ((h >> shift) & MASK)
+    index = (node.bitmap & (bit - 1)).bit_count()
+    if not node.bitmap & bit:
+        node = _editable(node, owner)
+        node.bitmap |= bit
+        node.items.insert(index, (key, value))
+        return node, True
+
+    item = node.items[index]
+    if isinstance(item, tuple):
+        if item[0] == key:
+            if item[1] is value:
+                return node, False
+            child, added = (key, value), False
+        else:
+            child = _pair(shift + BITS, _hash(item[0]), item, h, (key, value), owner)
+            added = True
+    else:
+        child, added = _set(item, h, shift + BITS, key, value, owner)
+        if child is item:
+            return node, added
+
+    node = _editable(node, owner)
+    node.items[index] = child
+    return node, added
+
+
+def _delete(node, h: int, shift: int, key, owner):
+    """Return the new node or _MISSING.
+
+    The node is a leaf tuple when it can be inlined and None when empty.
+    """
+    if isinstance(node, _Collision):
+        items = [item for item in node.items if item[0] != key]
+        if len(items) == len(node.items):
+            return _MISSING
+        if len(items) == 1:
+            return items[0]
+        return _Collision(node.hash, items, owner)
+
+    bit = 1 << ((h >> shift) & MASK)
+    if not node.bitmap & bit:
+        return _MISSING
+    index = (node.bitmap & (bit - 1)).bit_count()
+    item = node.items[index]
+    if isinstance(item, tuple):
+        if item[0] != key:
+            return _MISSING
+        child = None
+    else:
+        child = _delete(item, h, shift + BITS, key, owner)
+        if child is _MISSING:
+            return _MISSING
+
+    node = _editable(node, owner)
+    if child is None:
+        node.bitmap &= ~bit
+        del node.items[index]
+    else:
+        node.items[index] = child
+
+    if shift and len(node.items) == 1 and isinstance(node.items[0], tuple):
+        return node.items[0]
+    if shift and not node.items:
+        return None
+    return node
+
+
+def _iter(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        for item in node.items:
+            if isinstance(item, tuple):
+                yield item
+            else:
+                stack.append(item)
+
+
+class PersistentMap(Mapping):
+    """Immutable mapping whose `set` and `delete` return versions sharing structure"""
+
+    __slots__ = ("_root", "_size")
+
+    def __init__(self, root=_EMPTY, size: int = 0):
+        self._root = root
+        self._size = size
+
+    def __getitem__(self, key):
+        value = _get(self._root, _hash(key), 0, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return _get(self._root, _hash(key), 0, key, default)
+
+    def __contains__(self, key):
+        return _get(self._root, _hash(key), 0, key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for key, _ in _iter(self._root):
+            yield key
+
+    def items(self):
+        return _iter(self._root)
+
+    def set(self, key, value) -> "PersistentMap":
+        root, added = _set(self._root, _hash(key), 0, key, value, None)
+        return PersistentMap(root, self._size + added)
+
+    def delete(self, key) -> "PersistentMap":
+        root = _delete(self._root, _hash(key), 0, key, None)
+        if root is _MISSING:
+            raise KeyError(key)
+        return PersistentMap(root, self._size - 1)
+
+    def __repr__(self):
+        return f"PersistentMap({len(self)} items)"
+
+
+class SnapshotCache(PersistentMap, MutableMapping):
+    """Mutable PersistentMap with O(1) `snapshot()`"""
+
+    __slots__ = ("_owner",)
+
+    def __init__(self, base: Mapping = None):
+        super().__init__()
+        self._owner = object()
+        if isinstance(base, PersistentMap):
+            self._root, self._size = base._root, base._size
+        elif base:
+            self.update(base)
+
+    def __setitem__(self, key, value):
+        self._root, added = _set(self._root, _hash(key), 0, key, value, self._owner)
+        self._size += added
+
+    def __delitem__(self, key):
+        root = _delete(self._root, _hash(key), 0, key, self._owner)
+        if root is _MISSING:
+            raise KeyError(key)
+        self._root = root
+        self._size -= 1
+
+    def pop(self, key, default=_MISSING):
+        h = _hash(key)
+        value = _get(self._root, h, 0, key, _MISSING)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        self._root = _delete(self._root, h, 0, key, self._owner)
+        self._size -= 1
+        return value
+
+    def clear(self):
+        self._root, self._size = _EMPTY, 0
+
+    def snapshot(self) -> PersistentMap:
+        """Freeze the current contents, later writes copy the branches they touch"""
+        self._owner = object()
+        return PersistentMap(self._root, self._size)
+
+    def __repr__(self):
+        return f"SnapshotCache({len(self)} items)"
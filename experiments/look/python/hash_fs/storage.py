@@ -0,0 +1,240 @@
+"""Compact binary on-disk format for HashTree.
+
+Layout (little endian):
+
+    header   magic, version, digest size, hash algorithm, node count, offset
+             of the data section
+    records  one fixed-width record per node, in breadth-first order
+    data     node payloads, stored out of line
+
+Breadth-first order keeps the children of every node contiguous, so a record
+only needs the index of its first child and a child count. Loading maps the
+file and only materializes the nodes that are actually touched.
+"""
+
+import mmap
+import os
+import struct
+from binascii import hexlify, unhexlify
+from collections import deque
+
+from .__main__ import Node
+
+MAGIC = b"HSFT"
+VERSION = 2
+DIGEST_SIZE = 32
+
+HEADER = struct.Struct("<4sHH16sQQ")
+
+_MISSING = object()
+
+
+def record_struct(digest_size: int = DIGEST_SIZE) -> struct.Struct:
+    """digest, parent index, first child index, child count, data offset, data length"""
+    return struct.Struct(f"<{digest_size}siiIQI")
+
+
+def save_tree(root: Node, path: str) -> list[Node]:
+    """Write the tree under root to path, return the nodes in the order written.
+
+    The tree is written next to path and moved into place, so a tree loaded
+    from path keeps reading its untouched nodes from the old, still mapped
+    file while they are copied.
+    """
+    order = [root]
+    index = {id(root): 0}
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        for child in node.children:
+            index[id(child)] = len(order)
+            order.append(child)
+            queue.append(child)
+
+    hasher = root.hasher
+    record = record_struct(hasher.digest_size)
+    data_offset = HEADER.size + record.size * len(order)
+
+    tmp = f"{path}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    VERSION,
+                    hasher.digest_size,
+                    hasher.algorithm.encode(),
+                    len(order),
+                    data_offset,
+                )
+            )
+
+            offset = 0
+            first_child = 1
+            for node in order:
+                data = bytes(node.data)
+                children = node.children
+                parent = -1 if node.parent is None else index[id(node.parent)]
+                f.write(
+                    record.pack(
+                        unhexlify(node.hid),
+                        parent,
+                        first_child if children else -1,
+                        len(children),
+                        offset,
+                        len(data),
+                    )
+                )
+                first_child += len(children)
+                offset += len(data)
+
+            for node in order:
+                f.write(node.data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+    return order
+
+
+class MappedNodes:
+    """Memory-mapped node table of a saved tree.
+
+    Behaves like the `NodeSet` in `HashTree.nodes`: nodes are materialized on
+    first access, nodes appended after loading are kept in memory and removed
+    nodes are skipped. Closing it
+    (or leaving its `with` block) unmaps the file, after which nodes that
+    weren't materialized can't be read.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = struct.unpack_from("<4sH", self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{path} is not a hash tree (version {VERSION})")
+        _, _, digest_size, algorithm, count, data_offset = HEADER.unpack_from(
+            self._map, 0
+        )
+
+        self.algorithm = algorithm.rstrip(b"\0").decode()
+        self.digest_size = digest_size
+        self._record = record_struct(digest_size)
+        self._count = count
+        self._data_offset = data_offset
+        self._materialized: dict[int, "MappedNode"] = {}
+        self._appended: dict[int, Node] = {}
+        self._removed: set[int] = set()
+        self.tree = None
+
+    def record(self, index: int) -> tuple:
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._record.unpack_from(
+            self._map, HEADER.size + index * self._record.size
+        )
+
+    def node(self, index: int) -> "MappedNode":
+        node = self._materialized.get(index)
+        if node is None:
+            node = MappedNode(self, index)
+            self._materialized[index] = node
+        return node
+
+    def read(self, offset: int, length: int) -> bytes:
+        start = self._data_offset + offset
+        return self._map[start : start + length]
+
+    def append(self, node: Node):
+        self._appended[id(node)] = node
+
+    def discard(self, node: Node):
+        if isinstance(node, MappedNode) and node._nodes is self:
+            self._removed.add(node.index)
+        else:
+            self._appended.pop(id(node), None)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self._count - len(self._removed) + len(self._appended)
+
+    def __getitem__(self, index: int) -> Node:
+        """The node saved at index, whether or not it was removed since"""
+        if index < 0:
+            index += self._count
+        return self.node(index)
+
+    def __iter__(self):
+        for index in range(self._count):
+            if index not in self._removed:
+                yield self.node(index)
+        yield from self._appended.values()
+
+
+class MappedNode(Node):
+    """A Node whose parent, children and data are read from MappedNodes on use"""
+
+    def __init__(self, nodes: MappedNodes, index: int):
+        digest, parent, first_child, child_count, offset, length = nodes.record(index)
+        self._nodes = nodes
+        self.index = index
+        self._hid = hexlify(digest)
+        self._parent = _MISSING
+        self._children = None
+        self._data = _MISSING
+        self._tree = nodes.tree
+        self._parent_index = parent
+        self._child_span = (first_child, child_count)
+        self._data_span = (offset, length)
+
+    def _get_parent(self):
+        if self._parent is _MISSING:
+            index = self._parent_index
+            self._parent = None if index < 0 else self._nodes.node(index)
+        return self._parent
+
+    def _get_children(self):
+        if self._children is None:
+            first, count = self._child_span
+            self._children = [self._nodes.node(first + i) for i in range(count)]
+        return self._children
+
+    def _get_data(self):
+        if self._data is _MISSING:
+            self._data = self._nodes.read(*self._data_span)
+        return self._data
+
+    parent = property(_get_parent, Node.parent.fset)
+    children = property(_get_children)
+    data = property(_get_data, Node.data.fset)
+
+
+def load_tree(path: str, hasher=None) -> MappedNodes:
+    """Map the tree saved at path, nothing is materialized until accessed.
+
+    With a hasher, refuse a tree whose hids were made with another algorithm.
+    """
+    nodes = MappedNodes(path)
+    if hasher is not None and (nodes.algorithm, nodes.digest_size) != (
+        hasher.algorithm,
+        hasher.digest_size,
+    ):
+        nodes.close()
+        raise ValueError(
+            f"{path} was hashed with {nodes.algorithm}/{nodes.digest_size}, "
+            f"not {hasher}"
+        )
+    return nodes
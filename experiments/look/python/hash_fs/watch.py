@@ -0,0 +1,257 @@
+"""Keep an FSIndex up to date from inotify events.
+
+Every directory in the index gets a watch. Events are only collected into a
+set of relative paths until the tree has been quiet for `delay` seconds (or
+`max_delay` passed since the first one), then the whole burst goes through a
+single `FSIndex.refresh`, so a build writing thousands of files rehashes each
+ancestor once instead of once per event. Only the paths named by events are
+ever looked at, nothing is rescanned unless the kernel queue overflowed.
+
+A directory that can't be watched, typically because `max_user_watches` ran
+out, is reported with a warning. While any directory is unwatched the index
+is rescanned every `rescan_interval` seconds and the watch is retried.
+
+inotify is reached through ctypes, so this only works on Linux.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import time
+import warnings
+from select import select
+from typing import Callable, Iterator
+
+from .__main__ import FSIndex, FSNode
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+)
+
+EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal non-blocking inotify instance"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available on this platform")
+        self._libc = libc
+        self.fd = self._check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    @staticmethod
+    def _check(result: int) -> int:
+        if result < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        return result
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def add_watch(self, path: str, mask: int = WATCH_MASK) -> int:
+        return self._check(
+            self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        )
+
+    def rm_watch(self, wd: int):
+        self._check(self._libc.inotify_rm_watch(self.fd, wd))
+
+    def read(self) -> Iterator[tuple[int, int, int, str]]:
+        """Yield the (wd, mask, cookie, name) of every queued event"""
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = os.fsdecode(data[offset : offset + size].rstrip(b"\0"))
+                offset += size
+                yield wd, mask, cookie, name
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class Watcher:
+    def __init__(
+        self,
+        index: FSIndex,
+        delay: float = 0.2,
+        max_delay: float = 2.0,
+        rescan_interval: float = 60.0,
+    ):
+        if index.tree is None:
+            index.build()
+        self.index = index
+        self.delay = delay
+        self.max_delay = max_delay
+        self.rescan_interval = rescan_interval
+        self.inotify = Inotify()
+        self.watches: dict[int, str] = {}
+        self.dirs: dict[str, int] = {}
+        self.pending: set[str] = set()
+        self.overflowed = False
+        # directories add_watch failed on, only a rescan notices their changes
+        self.unwatched: set[str] = set()
+        for rel, node in index.entries.items():
+            if not node.is_file:
+                self._watch(rel)
+
+    def _watch(self, rel: str):
+        if rel in self.dirs:
+            return
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.index.path, rel))
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                # gone already, its parent's event covers that
+                return
+            if not self.unwatched:
+                warnings.warn(
+                    f"can't watch {rel or '.'}: {e}, rescanning every "
+                    f"{self.rescan_interval}s while directories are unwatched",
+                    RuntimeWarning,
+                )
+            self.unwatched.add(rel)
+            return
+        self.unwatched.discard(rel)
+        # the kernel hands out the same wd again for a directory that is already watched
+        self.dirs.pop(self.watches.get(wd), None)
+        self.watches[wd] = rel
+        self.dirs[rel] = wd
+
+    def _unwatch(self, rel: str):
+        self.unwatched.discard(rel)
+        wd = self.dirs.pop(rel, None)
+        if wd is None:
+            return
+        del self.watches[wd]
+        try:
+            self.inotify.rm_watch(wd)
+        except OSError:
+            pass
+
+    def _event(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        rel = self.watches.get(wd)
+        if rel is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            del self.dirs[rel]
+            return
+        path = os.path.join(rel, name) if name else rel
+        # watch new directories right away so nothing created inside them is missed
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            self._watch(path)
+        self.pending.add(path)
+
+    def _dirs_below(self, rel: str, node: FSNode):
+        return (
+            path for path, entry in self.index._subtree(rel, node) if not entry.is_file
+        )
+
+    def flush(self):
+        """Apply the pending events to the index"""
+        index = self.index
+        if self.overflowed:
+            self.overflowed = False
+            self.pending.clear()
+            index.rescan()
+            for rel in [rel for rel in self.dirs if rel not in index.entries]:
+                self._unwatch(rel)
+            self.unwatched.intersection_update(index.entries)
+            for rel, node in index.entries.items():
+                if not node.is_file:
+                    self._watch(rel)
+            return
+
+        paths, self.pending = self.pending, set()
+        before = {rel: index.entries.get(rel) for rel in paths}
+        index.refresh(paths)
+        for rel, old in before.items():
+            new = index.entries.get(rel)
+            if new is old:
+                continue
+            if old is not None and not old.is_file:
+                for path in self._dirs_below(rel, old):
+                    self._unwatch(path)
+            if new is not None and not new.is_file:
+                for path in self._dirs_below(rel, new):
+                    self._watch(path)
+
+    def run(self, callback: Callable[[FSIndex], None] = None):
+        """Block and keep the index up to date, calling callback after every batch"""
+        first = last = 0.0
+        rescanned = time.monotonic()
+        while True:
+            timeout = None
+            if self.pending or self.overflowed:
+                timeout = max(
+                    0.0,
+                    min(last + self.delay, first + self.max_delay) - time.monotonic(),
+                )
+            elif self.unwatched:
+                due = rescanned + self.rescan_interval - time.monotonic()
+                if due <= 0:
+                    # events in unwatched directories are lost, like on overflow
+                    self.overflowed = True
+                    rescanned = time.monotonic()
+                    timeout = 0.0
+                else:
+                    timeout = due
+            ready, _, _ = select([self.inotify], [], [], timeout)
+            if ready:
+                now = time.monotonic()
+                if not self.pending and not self.overflowed:
+                    first = now
+                last = now
+                for wd, mask, _, name in self.inotify.read():
+                    self._event(wd, mask, name)
+                continue
+            self.flush()
+            if callback is not None:
+                callback(self.index)
+
+    def close(self):
+        self.inotify.close()
@@ -0,0 +1,74 @@
+import random
+from contextlib import nullcontext
+
+from hash_fs import CompactTree, HashTree, Node
+
+
+def build(rng, batch):
+    """A random tree, built with or without deferring the rehashing"""
+    tree = CompactTree(b"root")
+    nodes = [tree.root]
+    with tree.batch() if batch else nullcontext():
+        for i in range(100):
+            nodes.append(rng.choice(nodes).add_child(b"%d" % i))
+        for _ in range(20):
+            rng.choice(nodes).data = bytes(rng.randrange(8))
+    return tree
+
+
+def shape(node):
+    return (bytes(node.data), [shape(child) for child in node.children])
+
+
+def test_batch_hashes_the_same():
+    for seed in range(20):
+        batched = build(random.Random(seed), True)
+        assert batched.digests == build(random.Random(seed), False).digests
+
+
+def test_from_node_round_trip():
+    rng = random.Random(0)
+    root = Node(b"root")
+    tree = HashTree(root)
+    nodes = [root]
+    for i in range(100):
+        node = Node(b"%d" % rng.randrange(1000))
+        tree.append_to(rng.choice(nodes), node)
+        nodes.append(node)
+
+    compact = CompactTree.from_node(root)
+    assert len(compact) == len(nodes)
+    assert shape(compact.root) == shape(root)
+
+    # the same tree built one node at a time
+    rebuilt = CompactTree(b"root")
+    queue = [(root, rebuilt.root)]
+    for node, view in queue:
+        for child in node.children:
+            queue.append((child, view.add_child(bytes(child.data))))
+    assert rebuilt.digests == compact.digests
+
+
+def test_set_data_shrinks_and_grows():
+    tree = CompactTree()
+    first = tree.root.add_child(b"first")
+    second = tree.root.add_child(b"second")
+
+    first.data = b"1"
+    assert first.data == b"1"
+    first.data = b"first, but longer"
+    second.data = b"second, but longer"
+    assert (first.data, second.data) == (b"first, but longer", b"second, but longer")
+
+    expected = CompactTree()
+    expected.root.add_child(b"first, but longer")
+    expected.root.add_child(b"second, but longer")
+    assert tree.digests == expected.digests
+
+    # each growing payload moves past the other one
+    for size in range(1000):
+        first.data = bytes(size)
+        second.data = b"2" * size
+    assert (first.data, second.data) == (bytes(999), b"2" * 999)
+    # the bytes they leave behind are reclaimed
+    assert len(tree.blob) <= 3 * 2 * 999
@@ -0,0 +1,55 @@
+import os
+
+from hash_fs.__main__ import FSIndex
+from hash_fs.dedup import DedupIndex
+
+
+def test_counts_follow_add_and_discard():
+    dedup = DedupIndex()
+    dedup.add("a", b"x", 10)
+    dedup.add("b", b"x", 10)
+    dedup.add("c", b"x", 10)
+    dedup.add("c", b"x", 10)
+    dedup.add("d", b"y", 3)
+    assert (dedup.duplicate_files, dedup.reclaimable) == (2, 20)
+    assert [group.paths for group in dedup.duplicates()] == [["a", "b", "c"]]
+
+    dedup.discard("c", b"x")
+    dedup.discard("c", b"x")
+    assert (dedup.duplicate_files, dedup.reclaimable) == (1, 10)
+
+    # a set down to one path goes back to a plain path
+    dedup.discard("a", b"x")
+    assert dedup._paths[b"x"] == "b"
+    assert dedup.paths(b"x") == ["b"]
+    assert (dedup.duplicate_files, dedup.reclaimable) == (0, 0)
+    assert not list(dedup.duplicates())
+
+    dedup.add("a", b"x", 10)
+    assert dedup.paths(b"x") == ["a", "b"]
+    dedup.discard("b", b"x")
+    dedup.discard("a", b"x")
+    assert b"x" not in dedup
+    assert len(dedup) == 1
+
+
+def test_rescan_keeps_duplicates_current(tmp_path):
+    root = tmp_path / "tree"
+    os.makedirs(root / "d")
+    for rel in ("one", "two", "d/three"):
+        (root / rel).write_bytes(b"same" * 100)
+    (root / "other").write_bytes(b"other")
+
+    index = FSIndex(root)
+    index.build()
+    (group,) = index.dedup.duplicates()
+    assert group.paths == ["d/three", "one", "two"]
+    assert (index.dedup.duplicate_files, index.dedup.reclaimable) == (2, 800)
+
+    (root / "two").write_bytes(b"changed")
+    os.remove(root / "d" / "three")
+    (root / "copy").write_bytes(b"other")
+    index.rescan()
+    assert [group.paths for group in index.dedup.duplicates()] == [["copy", "other"]]
+    assert (index.dedup.duplicate_files, index.dedup.reclaimable) == (1, 5)
+    assert index.dedup.paths(index.entries["one"].digest) == ["one"]
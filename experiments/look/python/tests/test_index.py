@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+from hash_fs.__main__ import FSIndex
+from hash_fs.hashing import Hasher
+
+HASHERS = [("sha256", None), ("blake2b", 16), ("blake2b", None), ("md5", None)]
+
+
+def make_tree(root):
+    os.makedirs(root / "a" / "b")
+    (root / "a" / "small").write_bytes(b"small")
+    (root / "a" / "b" / "same").write_bytes(b"small")
+    (root / "big").write_bytes(os.urandom(6 << 20))
+
+
+def build(root, algorithm, digest_size):
+    index = FSIndex(root, hasher=Hasher(algorithm, digest_size))
+    return index, index.build().root.hid
+
+
+def edit(path, offset, data):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+@pytest.mark.parametrize("algorithm, digest_size", HASHERS)
+def test_rescan_matches_build(tmp_path, algorithm, digest_size):
+    root = tmp_path / "tree"
+    make_tree(root)
+    index, _ = build(root, algorithm, digest_size)
+    saved = str(tmp_path / "index")
+    index.save(saved)
+
+    edit(root / "big", 3 << 20, b"edited")
+    (root / "a" / "b" / "new").write_bytes(os.urandom(5 << 20))
+    os.remove(root / "a" / "small")
+
+    loaded = FSIndex(root, hasher=Hasher(algorithm, digest_size))
+    loaded.load(saved)
+    rescanned = loaded.rescan().root.hid
+    assert len(rescanned) == 2 * loaded.hasher.digest_size
+    assert rescanned == build(root, algorithm, digest_size)[1]
+
+    edit(root / "a" / "b" / "new", 1 << 20, b"again")
+    assert loaded.rescan().root.hid == build(root, algorithm, digest_size)[1]
+
+
+def test_process_pool_matches_threads(tmp_path):
+    root = tmp_path / "tree"
+    make_tree(root)
+    threaded = FSIndex(root, workers=2).build().root.hid
+    assert FSIndex(root, workers=2, processes=True).build().root.hid == threaded
+
+
+def test_load_refuses_other_hasher(tmp_path):
+    root = tmp_path / "tree"
+    make_tree(root)
+    index, _ = build(root, "blake2b", 16)
+    index.save(str(tmp_path / "index"))
+
+    with pytest.raises(ValueError):
+        FSIndex(root, hasher=Hasher("sha256")).load(str(tmp_path / "index"))
+
+
+def test_hasher_refuses_xof():
+    with pytest.raises(ValueError):
+        Hasher("shake_128")
+
+
+def test_diff_saved_indexes_reports_chunked_file_modified(tmp_path):
+    from hash_fs.diff import MODIFIED, diff
+
+    root = tmp_path / "tree"
+    make_tree(root)
+    index, _ = build(root, "sha256", None)
+    index.save(str(tmp_path / "v1"))
+
+    edit(root / "big", 3 << 20, b"new")
+    index.rescan()
+    index.save(str(tmp_path / "v2"))
+
+    changes = [
+        (change.kind, b"/".join(change.path))
+        for change in diff(str(tmp_path / "v1"), str(tmp_path / "v2"))
+    ]
+    assert changes == [(MODIFIED, b"big")]
+
+
+def test_save_keeps_search_index_current(tmp_path):
+    from hash_fs.search import PathIndex
+
+    root = tmp_path / "tree"
+    os.makedirs(root / "d")
+    (root / "d" / "b").write_bytes(b"b")
+    saved = str(tmp_path / "index")
+    index = FSIndex(root)
+    index.build()
+    index.save(saved, index.search_index())
+
+    os.rename(root / "d", root / "z")
+    index.rescan()
+    index.save(saved)
+
+    paths = PathIndex.load(f"{saved}.paths")
+    assert paths.query("d/*") == []
+    assert paths.query("z/*") == ["z/b"]
+    paths.close()
+
+
+def test_empty_search_lists_every_path():
+    from hash_fs.search import PathIndex
+
+    paths = PathIndex.build(["a", "d/b", "d/c"])
+    assert paths.query("") == ["a", "d/b", "d/c"]
+    assert paths.query("", limit=1) == ["a"]
+    assert PathIndex.build([]).query("") == []
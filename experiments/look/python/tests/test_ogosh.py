@@ -0,0 +1,53 @@
+import pytest
+
+ogosh = pytest.importorskip("hash_fs.ogosh")
+
+
+def add_subtree(tree, parent):
+    top = ogosh.Node(b"top")
+    children = [ogosh.Node(b"left"), ogosh.Node(b"right")]
+    with tree.batch():
+        tree.append_to(parent, top)
+        for child in children:
+            tree.append_to(top, child)
+    return top, children
+
+
+def test_identical_subtrees_are_stored_once():
+    root = ogosh.Node(b"root")
+    tree = ogosh.HashTree(root)
+    first, _ = add_subtree(tree, root)
+    second, _ = add_subtree(tree, root)
+
+    assert first.hid == second.hid
+    assert len(tree.stored) == 7
+    # root, top, left and right
+    assert tree.graph.number_of_nodes() == 4
+    assert tree.refs[first.hid] == 2
+    assert (
+        list(tree.graph.successors(first.hid))
+        == tree.graph.nodes[first.hid]["children"]
+    )
+
+
+def test_editing_one_copy_keeps_the_other():
+    root = ogosh.Node(b"root")
+    tree = ogosh.HashTree(root)
+    first, (left, right) = add_subtree(tree, root)
+    second, _ = add_subtree(tree, root)
+    shared, old_left = second.hid, left.hid
+
+    left.data = b"changed"
+    assert first.hid != shared
+    assert second.hid == shared
+    assert tree.refs[shared] == 1
+    assert set(tree.graph.successors(shared)) == {old_left, right.hid}
+    assert set(tree.graph.successors(first.hid)) == {left.hid, right.hid}
+    assert tree.graph.nodes[old_left]["data"] == b"left"
+    assert tree.graph.number_of_nodes() == 6
+
+    # back to identical, the edited copy's nodes are released again
+    left.data = b"left"
+    assert first.hid == second.hid == shared
+    assert tree.refs[shared] == 2
+    assert tree.graph.number_of_nodes() == 4
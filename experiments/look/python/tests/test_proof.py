@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from hash_fs.__main__ import FSIndex
+from hash_fs.hashing import Hasher
+from hash_fs.proof import Proof, prove, prove_content, verify, verify_file
+
+HASHERS = [Hasher(), Hasher("blake2b", 16)]
+
+
+def make_index(root, hasher):
+    os.makedirs(root / "old")
+    os.makedirs(root / "new")
+    (root / "old" / "p").write_bytes(b"p")
+    (root / "new" / "q").write_bytes(b"q")
+    (root / "top").write_bytes(b"top")
+    index = FSIndex(root, hasher=hasher)
+    return index, index.build().root.hid
+
+
+@pytest.mark.parametrize("hasher", HASHERS)
+def test_valid_proofs(tmp_path, hasher):
+    index, root = make_index(tmp_path / "tree", hasher)
+    for rel in ("old/p", "new/q", "top"):
+        node = index.entries[rel]
+        for proof in (prove(node), prove_content(node)):
+            assert verify(proof, root, hasher=hasher)
+            assert verify(Proof.from_bytes(proof.to_bytes()), root, hasher=hasher)
+        assert verify_file(
+            str(tmp_path / "tree" / rel), rel, prove_content(node), root, hasher
+        )
+    assert verify(prove(index.entries["new"]), root, hasher=hasher)
+
+
+@pytest.mark.parametrize("hasher", HASHERS)
+def test_tampered_proofs(tmp_path, hasher):
+    index, root = make_index(tmp_path / "tree", hasher)
+    proof = prove(index.entries["new/q"])
+    leaf = proof.leaf
+    (parts, at), *rest = proof.steps
+
+    # a short leaf with the rest of its digest moved into the next part,
+    # which hashes the same bytes
+    forged = Proof(leaf[:10], [(parts[:at] + [leaf[10:]] + parts[at:], at)] + rest)
+    assert not verify(forged, root, hasher=hasher)
+    # the same with the leaf's end prepended to the part after it
+    if at < len(parts):
+        moved = parts[:at] + [leaf[10:] + parts[at]] + parts[at + 1 :]
+        assert not verify(Proof(leaf[:10], [(moved, at)] + rest), root, hasher=hasher)
+
+    # a hid in place of the data digest
+    assert not verify(Proof(leaf, [(parts, 0)] + rest), root, hasher=hasher)
+    # a truncated part
+    cut = [parts[0][:-2]] + parts[1:]
+    assert not verify(Proof(leaf, [(cut, at)] + rest), root, hasher=hasher)
+    # another leaf
+    other = prove(index.entries["old/p"]).leaf
+    assert not verify(Proof(other, proof.steps), root, hasher=hasher)
+    assert not verify(proof, root, leaf=other, hasher=hasher)
+
+
+def test_verify_file_checks_path(tmp_path):
+    index, root = make_index(tmp_path / "tree", Hasher())
+    copy = tmp_path / "copy"
+    copy.write_bytes(b"q")
+    proof = prove_content(index.entries["new/q"])
+
+    assert verify_file(str(copy), "new/q", proof, root)
+    assert not verify_file(str(copy), "old/q", proof, root)
+    assert not verify_file(str(copy), "new/p", proof, root)
+    assert not verify_file(str(copy), "q", proof, root)
+    assert not verify_file(str(copy), "new/q", prove(index.entries["new/q"]), root)
+
+    copy.write_bytes(b"not q")
+    assert not verify_file(str(copy), "new/q", proof, root)
@@ -0,0 +1,101 @@
+import random
+
+import pytest
+
+from hash_fs.snapshot import PersistentMap, SnapshotCache
+
+
+class Key:
+    """Key with a chosen hash, to force collisions and deep tries"""
+
+    def __init__(self, name: int, hash: int):
+        self.name = name
+        self.hash = hash
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        return isinstance(other, Key) and self.name == other.name
+
+    def __repr__(self):
+        return f"Key({self.name}, {self.hash:#x})"
+
+
+def keys(rng: random.Random, count: int) -> list:
+    """Plain keys plus keys sharing hashes or long hash prefixes"""
+    found = [rng.randrange(1 << 20) for _ in range(count)]
+    found += [Key(i, 0xBAD) for i in range(8)]
+    found += [Key(100 + i, (i << 60) | 0x1F) for i in range(8)]
+    found += [Key(200 + i, -1 - (i % 3)) for i in range(8)]
+    return found
+
+
+def check(mapping, expected: dict):
+    assert len(mapping) == len(expected)
+    assert dict(mapping.items()) == expected
+    assert set(mapping) == set(expected)
+    for key, value in expected.items():
+        assert key in mapping
+        assert mapping[key] == value
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_cache_matches_dict(seed):
+    rng = random.Random(seed)
+    pool = keys(rng, 200)
+    cache, model = SnapshotCache(), {}
+    snapshots: list[tuple[PersistentMap, dict]] = []
+
+    for step in range(2000):
+        key = rng.choice(pool)
+        op = rng.random()
+        if op < 0.5:
+            cache[key] = model[key] = step
+        elif op < 0.7:
+            assert cache.pop(key, None) == model.pop(key, None)
+        elif op < 0.8:
+            if key in model:
+                del cache[key]
+                del model[key]
+            else:
+                with pytest.raises(KeyError):
+                    del cache[key]
+        elif op < 0.85:
+            snapshots.append((cache.snapshot(), dict(model)))
+        elif op < 0.87 and snapshots:
+            # restore an old version and keep writing to it
+            snapshot, saved = rng.choice(snapshots)
+            cache, model = SnapshotCache(snapshot), dict(saved)
+        elif op < 0.88:
+            cache.clear()
+            model.clear()
+        assert cache.get(key) == model.get(key)
+
+        if step % 100 == 0:
+            check(cache, model)
+    check(cache, model)
+    # writes after a snapshot never show up in it
+    for snapshot, saved in snapshots:
+        check(snapshot, saved)
+
+
+def test_persistent_versions_are_independent():
+    rng = random.Random(0)
+    pool = keys(rng, 50)
+    versions = [(PersistentMap(), {})]
+    for step in range(500):
+        base, model = rng.choice(versions)
+        key = rng.choice(pool)
+        if key in model and rng.random() < 0.3:
+            version = base.delete(key)
+            model = {k: v for k, v in model.items() if k != key}
+        else:
+            version = base.set(key, step)
+            model = {**model, key: step}
+        versions.append((version, model))
+    for version, model in versions:
+        check(version, model)
+
+    with pytest.raises(KeyError):
+        PersistentMap().delete("missing")
@@ -0,0 +1,46 @@
+import os
+
+from hash_fs import HashTree, Node
+
+
+def make_tree():
+    root = Node()
+    tree = HashTree(root)
+    for i in range(50):
+        child = Node(b"dir%d" % i)
+        tree.append_to(root, child)
+        tree.append_to(child, Node(os.urandom(4096)))
+    return tree
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "tree")
+    tree = make_tree()
+    tree.save(path)
+
+    loaded = HashTree(Node()).load(path)
+    assert loaded.root.hid == tree.root.hid
+    assert len(loaded.nodes) == len(tree.nodes)
+    assert sorted(bytes(node.data) for node in loaded.nodes) == sorted(
+        bytes(node.data) for node in tree.nodes
+    )
+    loaded.close()
+
+
+def test_save_over_loaded_tree(tmp_path):
+    path = str(tmp_path / "tree")
+    make_tree().save(path)
+
+    loaded = HashTree(Node()).load(path)
+    loaded.root.children[0].data = b"changed"
+    loaded.save(path)
+    assert not os.path.exists(f"{path}.tmp")
+
+    reloaded = HashTree(Node()).load(path)
+    assert reloaded.root.hid == loaded.root.hid
+    assert bytes(reloaded.root.children[0].data) == b"changed"
+    assert [bytes(node.data) for node in reloaded.nodes] == [
+        bytes(node.data) for node in loaded.nodes
+    ]
+    loaded.close()
+    reloaded.close()
@@ -0,0 +1,87 @@
+import random
+
+from hash_fs import HashTree, Node
+from hash_fs.hashing import Hasher
+
+
+def full_scan(tree):
+    """The invalid nodes as found by checking every node against the cache"""
+    return {
+        id(node)
+        for node in tree.nodes
+        if node.hid not in tree.cache or node.hid != tree.cache[node.hid].hid
+    }
+
+
+def test_shared_hid_invalidated_with_cached_node():
+    root = Node()
+    tree = HashTree(root)
+    first, second = Node(b"!"), Node(b"!")
+    tree.append_to(root, first)
+    tree.append_to(root, second)
+    tree.initialize_cache()
+
+    cached = tree.cache[first.hid]
+    other = second if cached is first else first
+    cached.data = b"?"
+
+    invalid = {id(node) for node in tree.invalid_nodes}
+    assert id(other) in invalid
+    assert invalid == full_scan(tree)
+
+
+def test_dirty_set_matches_full_scan():
+    rng = random.Random(0)
+    for _ in range(200):
+        root = Node()
+        tree = HashTree(root)
+        nodes = [root]
+        for _ in range(30):
+            node = Node(bytes([rng.randrange(4)]))
+            tree.append_to(rng.choice(nodes), node)
+            nodes.append(node)
+        tree.initialize_cache()
+
+        for _ in range(40):
+            op = rng.random()
+            node = rng.choice(nodes)
+            if op < 0.5:
+                node.data = bytes([rng.randrange(4)])
+            elif op < 0.7:
+                tree.update_ancestry(node)
+            elif op < 0.8:
+                tree.invalidate_ancestry(node)
+            elif op < 0.85:
+                tree.dump_cache(clear_cache=rng.random() < 0.5)
+            elif op < 0.9 and tree.cache_histories:
+                tree.restore_cache(swap_cache=rng.random() < 0.5)
+            elif op < 0.95:
+                with tree.batch():
+                    for other in rng.sample(nodes, 3):
+                        other.data = bytes([rng.randrange(4)])
+            if rng.random() < 0.5:
+                invalid = {id(node) for node in tree.invalid_nodes}
+                assert invalid == full_scan(tree)
+
+
+def test_nodes_hashed_before_the_tree_use_its_hasher(tmp_path):
+    hasher = Hasher("blake2b", 16)
+    tree = HashTree(Node(b"x"), hasher)
+    assert tree.root.hid == hasher.digest(b"x")
+
+    leaf = Node(b"leaf")
+    sub = Node(b"sub", [leaf])
+    tree.append_to(tree.root, sub)
+    assert leaf.parent is sub and leaf._tree is tree
+    assert leaf.hid == hasher.digest(b"leaf")
+    assert sub.hid == hasher.digest(hasher.digest(b"sub") + leaf.hid)
+    assert len(tree.nodes) == 3
+
+    linked = HashTree(Node(b"x", [Node(b"sub", [Node(b"leaf")])]), hasher)
+    assert linked.root.hid == tree.root.hid
+
+    path = str(tmp_path / "tree")
+    tree.save(path)
+    loaded = HashTree(Node(), hasher).load(path)
+    assert loaded.root.hid == tree.root.hid
+    loaded.close()
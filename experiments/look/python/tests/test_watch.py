@@ -0,0 +1,54 @@
+import errno
+import os
+
+import pytest
+
+from hash_fs.__main__ import FSIndex
+
+watch = pytest.importorskip("hash_fs.watch")
+
+
+def test_unwatchable_directory_is_reported_and_rescanned(tmp_path, monkeypatch):
+    root = tmp_path / "tree"
+    os.makedirs(root / "full")
+    (root / "full" / "a").write_bytes(b"a")
+    add_watch = watch.Inotify.add_watch
+
+    def no_space(self, path, *args):
+        if path.endswith("full"):
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        return add_watch(self, path, *args)
+
+    monkeypatch.setattr(watch.Inotify, "add_watch", no_space)
+    with pytest.warns(RuntimeWarning, match="full"):
+        watcher = watch.Watcher(FSIndex(str(root)))
+    assert watcher.unwatched == {"full"}
+
+    (root / "full" / "b").write_bytes(b"b")
+    watcher.overflowed = True
+    watcher.flush()
+    assert "full/b" in watcher.index.entries
+    assert watcher.unwatched == {"full"}
+
+    monkeypatch.setattr(watch.Inotify, "add_watch", add_watch)
+    watcher.overflowed = True
+    watcher.flush()
+    assert not watcher.unwatched
+    assert "full" in watcher.dirs
+    watcher.close()
+
+
+def test_removed_nodes_leave_the_tree(tmp_path):
+    root = tmp_path / "tree"
+    os.makedirs(root / "d")
+    for name in "abc":
+        (root / "d" / name).write_bytes(name.encode())
+    index = FSIndex(str(root))
+    index.build()
+    count = len(index.tree.nodes)
+
+    os.remove(root / "d" / "b")
+    index.refresh(["d/b"])
+    assert len(index.tree.nodes) == count - 1
+    assert any(node is index.entries["d/a"] for node in index.tree.nodes)
+    assert all(node._tree is index.tree for node in index.tree.nodes)
@@ -1,3 +1,4 @@
+import argparse
 import asyncio
 import zmq.asyncio
 
@@ -29,12 +30,69 @@ class Peer:
                 print(f"Received response: {response}")
 
 
-async def main():
+async def demo():
     peer1 = Peer(b"Hello", True)
     peer2 = Peer([b"World", b"!"], False)
     tasks = [asyncio.create_task(peer1.run()), asyncio.create_task(peer2.run())]
     await asyncio.gather(*tasks)
 
 
+def _index(path: str):
+    try:
+        from hash_fs.__main__ import FSIndex
+    except ImportError:
+        raise SystemExit(
+            "sync needs the hash_fs package importable, "
+            "e.g. PYTHONPATH=experiments/look/python"
+        )
+    index = FSIndex(path)
+    index.build()
+    return index
+
+
+async def sync(source: str, destination: str, endpoint: str):
+    """Pull source into destination through a local server"""
+    from .sync import SyncClient, SyncServer
+
+    server = asyncio.create_task(SyncServer(_index(source), endpoint).run())
+    try:
+        print(await SyncClient(_index(destination), endpoint).pull())
+    finally:
+        server.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ZeroMQ peers")
+    parser.add_argument(
+        "--endpoint",
+        default="tcp://127.0.0.1:5555",
+        help="e.g. tcp://127.0.0.1:5555 or ipc:///tmp/syncope",
+    )
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="Serve a directory's hash tree")
+    serve.add_argument("path")
+    pull = commands.add_parser("pull", help="Make a directory match the served one")
+    pull.add_argument("path")
+    local = commands.add_parser(
+        "sync", help="Sync two local directories through the endpoint"
+    )
+    local.add_argument("source")
+    local.add_argument("destination")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from .sync import SyncServer
+
+        asyncio.run(SyncServer(_index(args.path), args.endpoint).run())
+    elif args.command == "pull":
+        from .sync import SyncClient
+
+        print(asyncio.run(SyncClient(_index(args.path), args.endpoint).pull()))
+    elif args.command == "sync":
+        asyncio.run(sync(args.source, args.destination, args.endpoint))
+    else:
+        asyncio.run(demo())
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
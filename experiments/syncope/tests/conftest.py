@@ -0,0 +1,8 @@
+import os
+import sys
+
+# hash_fs isn't packaged, use the copy in this repository
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, "look", "python"),
+)
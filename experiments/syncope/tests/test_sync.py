@@ -0,0 +1,169 @@
+import asyncio
+import os
+from hashlib import sha256
+
+import pytest
+
+import hash_fs.__main__ as hash_fs
+
+from syncope.sync import (
+    ENTRY,
+    FILE,
+    FILE_INFO,
+    PART_SUFFIX,
+    READ,
+    READ_BATCH,
+    SyncClient,
+    SyncServer,
+)
+
+
+def index(path, hasher=None):
+    index = hash_fs.FSIndex(path, hasher=hasher)
+    index.build()
+    return index
+
+
+def sync(server: SyncServer, destination, hasher=None, client_class=SyncClient):
+    client = index(destination, server.index.hasher if hasher is None else hasher)
+
+    async def pull():
+        serving = asyncio.create_task(server.run())
+        try:
+            return await client_class(client, server.endpoint).pull()
+        finally:
+            serving.cancel()
+
+    return client, asyncio.run(pull())
+
+
+def endpoint(tmp_path) -> str:
+    return f"ipc://{tmp_path}/sync.ipc"
+
+
+def contents(root) -> dict:
+    """Every file and directory under root, files with their bytes"""
+    found = {}
+    for dirpath, dirs, files in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in dirs:
+            found[os.path.join(rel, name)] = None
+        for name in files:
+            with open(os.path.join(dirpath, name), "rb") as f:
+                found[os.path.join(rel, name)] = f.read()
+    return found
+
+
+@pytest.fixture
+def trees(tmp_path):
+    # same directory name on both sides, so the roots hash the same
+    source, destination = (
+        tmp_path / "source" / "tree",
+        tmp_path / "destination" / "tree",
+    )
+    big = os.urandom(READ_BATCH + (3 << 20))
+
+    os.makedirs(source / "a" / "b")
+    os.makedirs(source / "c")
+    (source / "a" / "small").write_bytes(b"small")
+    (source / "a" / "b" / "copy").write_bytes(b"small")
+    (source / "a" / "empty").write_bytes(b"")
+    (source / "big").write_bytes(big)
+    (source / "was_dir").write_bytes(b"now a file")
+    (source / "kept").write_bytes(os.urandom(1 << 16))
+    (source / "c" / "copy").write_bytes((source / "kept").read_bytes())
+
+    os.makedirs(destination / "a")
+    os.makedirs(destination / "was_dir" / "inside")
+    (destination / "a" / "small").write_bytes(b"old")
+    (destination / "gone").write_bytes(b"gone")
+    (destination / "kept").write_bytes((source / "kept").read_bytes())
+    # the old version of big differs in the middle, the chunks around it are reused
+    edited = bytearray(big)
+    edited[len(big) // 2 : len(big) // 2 + 8] = b"oldbytes"
+    (destination / "big").write_bytes(edited)
+    return source, destination
+
+
+@pytest.mark.parametrize("hasher", [None, hash_fs.Hasher("blake2b", 16)])
+def test_pull_matches_source(tmp_path, trees, hasher):
+    source, destination = trees
+    server = SyncServer(index(source, hasher), endpoint(tmp_path))
+
+    client, stats = sync(server, destination)
+
+    assert contents(destination) == contents(source)
+    assert client.tree.root.hid == index(destination, hasher).tree.root.hid
+    assert client.tree.root.hid == server.index.tree.root.hid
+    assert stats.failed == 0
+    # gone and the directory was_dir
+    assert stats.removed == 2
+    # c/copy is copied from kept, big reuses its unchanged chunks
+    assert stats.copied == 1
+    assert stats.reused_bytes > 0
+
+    _, again = sync(server, destination)
+    assert (again.fetched, again.copied, again.removed) == (0, 0, 0)
+
+
+def test_failed_pull_leaves_no_parts(tmp_path, trees):
+    source, destination = trees
+
+    class FailingClient(SyncClient):
+        async def _request(self, command, frames):
+            if command == READ:
+                raise ConnectionError("server went away")
+            return await super()._request(command, frames)
+
+    with pytest.raises(ConnectionError):
+        sync(
+            SyncServer(index(source), endpoint(tmp_path)),
+            destination,
+            client_class=FailingClient,
+        )
+    parts = [rel for rel in contents(destination) if rel.endswith(PART_SUFFIX)]
+    assert parts == []
+
+
+def test_different_hashers_are_refused(tmp_path, trees):
+    source, destination = trees
+    server = SyncServer(index(source), endpoint(tmp_path))
+
+    with pytest.raises(ValueError):
+        sync(server, destination, hash_fs.Hasher("blake2b"))
+
+
+EVIL = b"evil"
+
+
+class EscapingServer(SyncServer):
+    """Lists names that would leave the synced directory and serves them"""
+
+    def _list(self, frames):
+        size = self.index.hasher.digest_size
+        evil = b"".join(
+            ENTRY.pack(FILE, len(name)) + name + bytes(size)
+            for name in (b"..", b"../escaped", b"a/b", b"", b".", b"x\0y")
+        )
+        return [evil + listing for listing in super()._list(frames)]
+
+    def _files(self, frames):
+        info = FILE_INFO.pack(sha256(EVIL).digest(), len(EVIL), 0)
+        return [reply or info for reply in super()._files(frames)]
+
+    def _read(self, frames):
+        return [reply or EVIL for reply in super()._read(frames)]
+
+
+def test_unsafe_names_are_refused(tmp_path):
+    source, destination = tmp_path / "source", tmp_path / "destination"
+    source.mkdir()
+    destination.mkdir()
+    (source / "kept").write_bytes(b"kept")
+
+    _, stats = sync(EscapingServer(index(source), endpoint(tmp_path)), destination)
+
+    assert stats.failed == 6
+    assert (destination / "kept").read_bytes() == b"kept"
+    assert not (tmp_path / "escaped").exists()
+    assert sorted(os.listdir(destination)) == ["kept"]
@@ -0,0 +1,58 @@
+from aiohttp import web
+
+
+class Resource:
+    """A body served like a static file: with an ETag, ranges and revalidation.
+
+    Every request's method and headers are recorded in `requests`.
+    """
+
+    def __init__(self, body: bytes, etag='"v1"', ranges=True, head=True):
+        self.body = body
+        self.etag = etag
+        self.ranges = ranges
+        self.head = head
+        self.requests: list[tuple[str, dict]] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append((request.method, dict(request.headers)))
+        if request.method == "HEAD" and not self.head:
+            raise web.HTTPMethodNotAllowed("HEAD", ["GET"])
+        headers = {"ETag": self.etag}
+        if self.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304, headers=headers)
+
+        requested = request.headers.get("Range")
+        if_range = request.headers.get("If-Range", self.etag)
+        if not (self.ranges and requested and if_range == self.etag):
+            return web.Response(body=self.body, headers=headers)
+        size = len(self.body)
+        start, _, end = requested.removeprefix("bytes=").partition("-")
+        start, end = int(start), min(int(end or size - 1), size - 1)
+        if start >= size:
+            headers["Content-Range"] = f"bytes */{size}"
+            return web.Response(status=416, headers=headers)
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        return web.Response(
+            status=206, body=self.body[start : end + 1], headers=headers
+        )
+
+    def ranges_requested(self) -> list[str]:
+        return [headers.get("Range") for method, headers in self.requests]
+
+
+async def serve(resource: Resource, test):
+    """Run test with the URL of resource on a local server, as /file.bin"""
+    app = web.Application()
+    app.router.add_route("*", "/file.bin", resource.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        host, port = runner.addresses[0][:2]
+        return await test(f"http://{host}:{port}/file.bin")
+    finally:
+        await runner.cleanup()
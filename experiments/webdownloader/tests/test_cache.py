@@ -0,0 +1,129 @@
+import asyncio
+import os
+import threading
+
+from webdownloader import cache as cache_module
+from webdownloader.__main__ import WebDownloader
+from webdownloader.cache import HttpCache
+
+from .server import Resource, serve
+
+HEADERS = {"ETag": '"v1"'}
+
+
+def bodies(cache) -> list[str]:
+    return sorted(os.path.join(cache.bodies, name) for name in os.listdir(cache.bodies))
+
+
+def test_store_and_reload(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"))
+    cache.store("a", {}, b"no validators")
+    assert cache.headers("a") == {}
+
+    cache.store(
+        "a", {**HEADERS, "Last-Modified": "yesterday"}, b"body", charset="utf-8"
+    )
+    cache.save()
+    reloaded = HttpCache(str(tmp_path / "cache"))
+    assert reloaded.headers("a") == {
+        "If-None-Match": '"v1"',
+        "If-Modified-Since": "yesterday",
+    }
+    assert reloaded.read("a") == b"body"
+    assert reloaded.charset("a") == "utf-8"
+
+
+def test_least_recently_used_is_evicted(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"), max_bytes=250)
+    cache.store("a", HEADERS, b"a" * 100)
+    cache.store("b", HEADERS, b"b" * 100)
+    assert cache.read("a") == b"a" * 100
+    cache.store("c", HEADERS, b"c" * 100)
+
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.size == 200
+    assert cache.read("b") is None
+    assert bodies(cache) == sorted([cache._path("a"), cache._path("c")])
+
+
+def test_too_large_is_not_stored(tmp_path):
+    cache = HttpCache(str(tmp_path / "cache"), max_bytes=250)
+    cache.store("a", HEADERS, b"a" * 100)
+    cache.store("big", HEADERS, b"b" * 300)
+    source = tmp_path / "big"
+    source.write_bytes(b"b" * 300)
+    cache.store("big", HEADERS, source=str(source))
+
+    assert list(cache.entries) == ["a"]
+    assert cache.size == 100
+    assert bodies(cache) == [cache._path("a")]
+
+
+def test_evicted_after_hit_is_a_miss(tmp_path, monkeypatch):
+    cache = HttpCache(str(tmp_path / "cache"), max_bytes=150)
+    cache.store("a", HEADERS, b"a" * 100)
+    hit = cache.hit
+
+    def evicting_hit(url):
+        # another download stores a body that pushes url's out
+        path = hit(url)
+        cache.store("b", HEADERS, b"b" * 100)
+        return path
+
+    monkeypatch.setattr(cache, "hit", evicting_hit)
+    assert cache.read("a") is None
+    cache.store("a", HEADERS, b"a" * 100)
+    assert not cache.restore("a", str(tmp_path / "restored"))
+    assert not os.path.exists(tmp_path / "restored")
+    assert not os.path.exists(tmp_path / "restored.cached")
+
+
+def test_concurrent_stores_of_one_url(tmp_path, monkeypatch):
+    cache = HttpCache(str(tmp_path / "cache"))
+    sources = [tmp_path / "first", tmp_path / "second"]
+    for source, data in zip(sources, (b"1" * 10, b"2" * 20)):
+        source.write_bytes(data)
+    both = threading.Barrier(2)
+    clone = cache_module._clone
+
+    def clone_together(source, destination):
+        both.wait(5)
+        clone(source, destination)
+        both.wait(5)
+
+    monkeypatch.setattr(cache_module, "_clone", clone_together)
+    errors = []
+
+    def store(source):
+        try:
+            cache.store("a", HEADERS, source=str(source))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=store, args=(source,)) for source in sources]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert cache.read("a") in (b"1" * 10, b"2" * 20)
+    assert cache.size == len(cache.read("a"))
+    assert bodies(cache) == [cache._path("a")]
+
+
+def test_not_modified_restores_the_cached_copy(tmp_path):
+    resource = Resource(b"body" * 1000)
+    cache = HttpCache(str(tmp_path / "cache"))
+
+    async def run(url):
+        downloader = WebDownloader(cache=cache)
+        try:
+            await downloader.download((url, str(tmp_path / "first")))
+            await downloader.download((url, str(tmp_path / "second")))
+        finally:
+            await downloader.close()
+
+    asyncio.run(serve(resource, run))
+    assert (tmp_path / "second" / "file.bin").read_bytes() == resource.body
+    assert resource.requests[1][1]["If-None-Match"] == '"v1"'
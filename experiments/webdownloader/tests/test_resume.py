@@ -0,0 +1,80 @@
+import asyncio
+import os
+
+from webdownloader.__main__ import WebDownloader
+from webdownloader.resume import Partial
+
+from .server import Resource, serve
+
+BODY = bytes(range(256)) * 64
+
+
+def download(resource, directory, part=None, **state):
+    """Download resource into directory, resuming part saved with the sidecar state"""
+
+    async def run(url):
+        path = str(directory / "file.bin")
+        if part is not None:
+            (directory / "file.bin.part").write_bytes(part)
+            Partial(path, url, **state).save()
+        downloader = WebDownloader(chunk_size=1000)
+        try:
+            await downloader.download((url, str(directory)))
+        finally:
+            await downloader.close()
+
+    asyncio.run(serve(resource, run))
+    assert not os.path.exists(directory / "file.bin.part")
+    assert not os.path.exists(directory / "file.bin.part.json")
+    return (directory / "file.bin").read_bytes()
+
+
+def test_load(tmp_path):
+    path = str(tmp_path / "file")
+    assert Partial.load(path, "url") is None
+
+    (tmp_path / "file.part").write_bytes(b"12345")
+    Partial(path, "url", '"v1"', None, 5).save()
+    assert Partial.load(path, "url") == Partial(path, "url", '"v1"', None, 5)
+    assert Partial.load(path, "other") is None
+
+    # weak ETags can't be used with If-Range
+    Partial(path, "url", 'W/"v1"', None, 5).save()
+    assert Partial.load(path, "url") is None
+    Partial(path, "url", 'W/"v1"', "yesterday", 5).save()
+    assert Partial.load(path, "url").validator == "yesterday"
+
+
+def test_resume(tmp_path):
+    resource = Resource(BODY)
+    assert download(resource, tmp_path, BODY[:5000], etag='"v1"', offset=5000) == BODY
+    assert resource.ranges_requested() == ["bytes=5000-"]
+    assert resource.requests[0][1]["If-Range"] == '"v1"'
+
+
+def test_already_complete(tmp_path):
+    resource = Resource(BODY)
+    assert download(resource, tmp_path, BODY, etag='"v1"', offset=len(BODY)) == BODY
+    assert resource.ranges_requested() == [f"bytes={len(BODY)}-"]
+
+
+def test_416_restarts(tmp_path):
+    # the part is longer than the resource now is, under the same ETag
+    resource = Resource(BODY[:1000])
+    part = BODY[:5000]
+    assert download(resource, tmp_path, part, etag='"v1"', offset=5000) == BODY[:1000]
+    assert resource.ranges_requested() == ["bytes=5000-", None]
+
+
+def test_changed_resource_replaces_the_part(tmp_path):
+    resource = Resource(BODY, etag='"v2"')
+    part = b"x" * 5000
+    assert download(resource, tmp_path, part, etag='"v1"', offset=5000) == BODY
+    assert resource.ranges_requested() == ["bytes=5000-"]
+
+
+def test_offset_clamped_to_part(tmp_path):
+    # the sidecar was saved after a write that never reached the part
+    resource = Resource(BODY)
+    assert download(resource, tmp_path, BODY[:3000], etag='"v1"', offset=5000) == BODY
+    assert resource.ranges_requested() == ["bytes=3000-"]
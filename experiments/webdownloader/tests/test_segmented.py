@@ -0,0 +1,54 @@
+import asyncio
+
+from webdownloader.__main__ import WebDownloader
+
+from .server import Resource, serve
+
+BODY = bytes(range(256)) * 64
+
+
+def download(resource, directory, segments=4):
+    async def run(url):
+        downloader = WebDownloader(
+            chunk_size=1000, segments=segments, min_segment_size=1024
+        )
+        try:
+            await downloader.download((url, str(directory)))
+        finally:
+            await downloader.close()
+
+    asyncio.run(serve(resource, run))
+    return (directory / "file.bin").read_bytes()
+
+
+def test_segments(tmp_path):
+    resource = Resource(BODY)
+    assert download(resource, tmp_path) == BODY
+    assert [method for method, _ in resource.requests] == ["HEAD"] + 4 * ["GET"]
+    assert sorted(resource.ranges_requested()[1:]) == [
+        "bytes=0-4095",
+        "bytes=12288-16383",
+        "bytes=4096-8191",
+        "bytes=8192-12287",
+    ]
+    assert all(headers["If-Range"] == '"v1"' for _, headers in resource.requests[1:])
+
+
+def test_small_download_uses_one_stream(tmp_path):
+    resource = Resource(BODY[:3000])
+    assert download(resource, tmp_path) == BODY[:3000]
+    assert resource.ranges_requested() == [None, None]
+
+
+def test_no_ranges_uses_one_stream(tmp_path):
+    resource = Resource(BODY, ranges=False)
+    assert download(resource, tmp_path) == BODY
+    assert [method for method, _ in resource.requests] == ["HEAD", "GET"]
+    assert resource.ranges_requested() == [None, None]
+
+
+def test_head_not_allowed_uses_one_stream(tmp_path):
+    resource = Resource(BODY, head=False)
+    assert download(resource, tmp_path) == BODY
+    assert [method for method, _ in resource.requests] == ["HEAD", "GET"]
+    assert resource.ranges_requested() == [None, None]
@@ -2,15 +2,110 @@ import asyncio
 import signal
 import argparse
 import os
-import requests
+import aiohttp
 from urllib.parse import urlparse
 
+from .cache import HttpCache
+from .hosts import HostQueue
+from .resume import Partial
+
+# byte offsets and lengths have to be those of the file itself, not of a
+# compressed encoding of it that aiohttp decodes on the fly
+IDENTITY = {"Accept-Encoding": "identity"}
+
+
+def _encoded(response) -> bool:
+    return response.headers.get("Content-Encoding", "identity").lower() != "identity"
+
+
+def _range_start(response) -> int:
+    """First byte of a 206 response's Content-Range, bytes <start>-<end>/<total>"""
+    try:
+        return int(response.headers["Content-Range"].split()[1].split("-")[0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+
+async def _pwrite(fd, data, position):
+    """os.pwrite on a worker thread, finishing the write even if cancelled"""
+    write = asyncio.ensure_future(asyncio.to_thread(os.pwrite, fd, data, position))
+    try:
+        await asyncio.shield(write)
+    except asyncio.CancelledError:
+        # the thread can't be stopped, don't let the caller close fd under it
+        await write
+        raise
+
 
 class WebDownloader:
-    def __init__(self, max_concurrent_downloads=3):
+    """Downloads queued URLs with max_concurrent_downloads long-lived workers.
+
+    Each worker takes the next download off the queue as soon as its current
+    one finishes, so every slot stays busy while there is work. URLs can be
+    queued at any time; with queue_size the queue is bounded and
+    `queue_download` waits for room, which keeps huge URL lists from being
+    loaded all at once.
+
+    Files are written to a .part file with a sidecar holding the response's
+    validator and offset, so an interrupted download picks up where it left
+    off on the next run (see `resume.Partial`).
+
+    Workers are handed downloads round-robin across hosts, with at most
+    per_host running against one host and host_delay seconds between the
+    starts of its requests, so a list dominated by one origin doesn't hammer
+    it or starve the others.
+
+    With segments above 1, a new download of at least segments *
+    min_segment_size bytes from a server that sends Accept-Ranges is split
+    into that many byte ranges fetched over parallel connections, which gets
+    past a per-connection throughput cap. Other downloads use one stream.
+
+    With a cache, URLs downloaded before are requested conditionally and a
+    304 puts the cached copy in place instead of transferring the body again.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_downloads=3,
+        chunk_size=1 << 20,
+        queue_size=0,
+        per_host=2,
+        host_delay=0.0,
+        segments=1,
+        min_segment_size=1 << 22,
+        cache: HttpCache = None,
+    ):
         self.max_concurrent_downloads = max_concurrent_downloads
-        self.downloads = asyncio.Queue()
+        self.chunk_size = chunk_size
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.cache = cache
+        self.downloads = HostQueue(queue_size, per_host, host_delay)
         self.active_downloads = []
+        self.completed = []
+        self.failed = []
+        self.workers: list[asyncio.Task] = []
+        self._session: aiohttp.ClientSession = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """One pooled session shared by every download, so connections are reused"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrent_downloads * self.segments,
+                limit_per_host=self.downloads.per_host * self.segments,
+                ttl_dns_cache=300,
+            )
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.save)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
 
     async def download(self, dl):
         url, download_dir = dl
@@ -22,32 +117,245 @@ class WebDownloader:
         filename = os.path.basename(parsed_url.path)
 
         # Create the download directory if it does not exist
-        os.makedirs(download_dir, exist_ok=True)
+        await asyncio.to_thread(os.makedirs, download_dir, exist_ok=True)
+
+        path = os.path.join(download_dir, filename)
+        partial = await asyncio.to_thread(Partial.load, path, url)
+        if partial is not None:
+            headers = partial.headers()
+        elif self.segments > 1 and await self._segmented(url, path):
+            return dl
+        else:
+            headers = self._conditional(url)
+        headers = {**(headers or {}), **IDENTITY}
+
+        # Stream the response into the .part file, writing chunk_size blocks
+        # on a worker thread while the next block is being received
+        async with self.session.get(url, headers=headers) as response:
+            if response.status == 416 and partial is not None:
+                if response.headers.get("Content-Range") == f"bytes */{partial.offset}":
+                    # interrupted after the last byte was written
+                    await asyncio.to_thread(partial.finish)
+                    return dl
+                # the part is no longer a prefix of the resource
+                response.release()
+                await asyncio.to_thread(partial.discard)
+                return await self.download(dl)
+            if response.status == 304 and await self._not_modified(url, path):
+                return dl
+            if response.status == 304:
+                # evicted in the meantime, ask again without the validators
+                response.release()
+                return await self.download(dl)
+            response.raise_for_status()
 
-        # Send the request and download the file
-        response = requests.get(url, stream=True)
-        with open(os.path.join(download_dir, filename), "wb") as f:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
+            offset = 0
+            encoded = _encoded(response)
+            if response.status == 206:
+                if (
+                    encoded
+                    or partial is None
+                    or _range_start(response) != partial.offset
+                ):
+                    raise ValueError(
+                        "unexpected partial response "
+                        f"{response.headers.get('Content-Range')}"
+                    )
+                offset = partial.offset
+            # a server that encodes anyway gets no validators, so no resume
+            partial = Partial(
+                path,
+                url,
+                None if encoded else response.headers.get("ETag"),
+                None if encoded else response.headers.get("Last-Modified"),
+                offset,
+            )
+            f = await asyncio.to_thread(partial.open)
+            writing = None
+            try:
+                buffer = bytearray()
+                async for data in response.content.iter_chunked(self.chunk_size):
+                    buffer += data
+                    if len(buffer) >= self.chunk_size:
+                        if writing is not None:
+                            await asyncio.shield(writing)
+                        writing = asyncio.ensure_future(
+                            asyncio.to_thread(partial.append, f, buffer)
+                        )
+                        buffer = bytearray()
+                if writing is not None:
+                    await asyncio.shield(writing)
+                if buffer:
+                    await asyncio.to_thread(partial.append, f, buffer)
+            finally:
+                # a block still being written on its thread can't be stopped
+                if writing is not None and not writing.done():
+                    await asyncio.wait([writing])
+                await asyncio.to_thread(f.close)
+
+            # Content-Length counts the encoded bytes
+            length = None if encoded else response.content_length
+            if length is not None and partial.offset != offset + length:
+                raise ValueError(f"got {partial.offset - offset} of {length} bytes")
+        await asyncio.to_thread(partial.finish)
+        await self._cache(url, response.headers, path)
 
         return dl
 
+    def _conditional(self, url):
+        """Validators of url's cached copy to revalidate it with"""
+        if self.cache is None:
+            return None
+        return self.cache.headers(url) or None
+
+    async def _not_modified(self, url, path) -> bool:
+        return await asyncio.to_thread(self.cache.restore, url, path)
+
+    async def _cache(self, url, headers, path):
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.store, url, headers, source=path)
+
+    async def _segmented(self, url, path) -> bool:
+        """Fetch url as parallel byte ranges, False if the server can't serve them"""
+        headers = {**(self._conditional(url) or {}), **IDENTITY}
+        async with self.session.head(
+            url, headers=headers, allow_redirects=True
+        ) as response:
+            if response.status == 304:
+                return await self._not_modified(url, path)
+            if not 200 <= response.status < 300:
+                # e.g. 405 from a server that doesn't do HEAD, a plain GET may work
+                return False
+            length = response.content_length
+            if (
+                response.headers.get("Accept-Ranges", "").lower() != "bytes"
+                or _encoded(response)
+                or not length
+            ):
+                return False
+            if length < self.segments * self.min_segment_size:
+                return False
+            # make sure every range comes from the same version of the resource
+            headers = response.headers
+            partial = Partial(
+                path, url, headers.get("ETag"), headers.get("Last-Modified")
+            )
+
+        def allocate():
+            fd = os.open(partial.part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, length)
+            else:
+                os.ftruncate(fd, length)
+            return fd
+
+        fd = await asyncio.to_thread(allocate)
+        bounds = [length * i // self.segments for i in range(self.segments + 1)]
+        ranges = [
+            asyncio.create_task(
+                self._fetch_range(url, partial.validator, fd, start, end)
+            )
+            for start, end in zip(bounds, bounds[1:])
+        ]
+        try:
+            sizes = await asyncio.gather(*ranges)
+            if sum(sizes) != length:
+                raise ValueError(f"got {sum(sizes)} of {length} bytes")
+        except BaseException:
+            # nothing may write to fd once it is closed, its number gets reused
+            for task in ranges:
+                task.cancel()
+            await asyncio.gather(*ranges, return_exceptions=True)
+            await asyncio.to_thread(os.close, fd)
+            await asyncio.to_thread(partial.discard)
+            raise
+        await asyncio.to_thread(os.close, fd)
+        await asyncio.to_thread(partial.finish)
+        await self._cache(url, headers, path)
+        return True
+
+    async def _fetch_range(self, url, validator, fd, start, end) -> int:
+        """Write bytes [start, end) of url at the same offsets of fd.
+
+        Returns how many arrived.
+        """
+        headers = {"Range": f"bytes={start}-{end - 1}", **IDENTITY}
+        if validator is not None:
+            headers["If-Range"] = validator
+        async with self.session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            if (
+                response.status != 206
+                or _encoded(response)
+                or _range_start(response) != start
+            ):
+                raise ValueError(
+                    f"{url} changed or ignored the range {start}-{end - 1}"
+                )
+            position = start
+            buffer = bytearray()
+            async for data in response.content.iter_chunked(self.chunk_size):
+                buffer += data
+                if len(buffer) >= self.chunk_size:
+                    await _pwrite(fd, buffer, position)
+                    position += len(buffer)
+                    buffer = bytearray()
+            if buffer:
+                await _pwrite(fd, buffer, position)
+                position += len(buffer)
+        if position != end:
+            raise ValueError(
+                f"got {position - start} of {end - start} bytes "
+                f"of range {start}-{end - 1}"
+            )
+        return position - start
+
     async def queue_download(self, url, download_dir=None):
         await self.downloads.put((url, download_dir))
 
-    async def _start_downloads(self):
-        while (
-            len(self.active_downloads) < self.max_concurrent_downloads
-            and not self.downloads.empty()
-        ):
+    async def _worker(self):
+        while True:
             dl = await self.downloads.get()
-            download_task = asyncio.ensure_future(self.download(dl))
-            self.active_downloads.append(download_task)
-            download_task.add_done_callback(self._on_download_complete)
+            self.active_downloads.append(dl)
+            try:
+                self.completed.append(await self.download(dl))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Failed to download {dl[0]}: {e}")
+                self.failed.append(dl)
+            finally:
+                self.active_downloads.remove(dl)
+                self.downloads.task_done(dl)
+
+    def start(self):
+        """Start the workers.
+
+        Downloads queued before or after this are picked up as slots free up.
+        """
+        while len(self.workers) < self.max_concurrent_downloads:
+            self.workers.append(asyncio.create_task(self._worker()))
 
-    def _on_download_complete(self, task):
-        result = task.result()
-        self.active_downloads.remove(task)
+    async def join(self):
+        """Wait until every queued download has finished"""
+        await self.downloads.join()
+
+    async def stop(self):
+        """Cancel the workers, downloads still running are abandoned"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        if exc[0] is None:
+            await self.join()
+        await self.stop()
+        await self.close()
 
     def is_idle(self):
         print(
@@ -56,19 +364,31 @@ class WebDownloader:
         return len(self.active_downloads) == 0 and self.downloads.empty()
 
 
-async def asy_main(args):
-    try:
-        downloader = WebDownloader(max_concurrent_downloads=args.concurrency)
-        loop = asyncio.get_running_loop()
-        loop.add_signal_handler(signal.SIGINT, downloader.is_idle)
-
-        for url in args.urls:
-            await downloader.queue_download(url, args.output)
+def read_urls(args):
+    yield from args.urls
+    if args.file:
+        with open(args.file, "r") as f:
+            for line in f:
+                if url := line.strip():
+                    yield url
 
-        await downloader._start_downloads()
 
-        while not downloader.is_idle():
-            await asyncio.sleep(1)
+async def asy_main(args):
+    downloader = WebDownloader(
+        max_concurrent_downloads=args.concurrency,
+        chunk_size=args.chunk_size,
+        queue_size=args.concurrency * 4,
+        per_host=args.per_host,
+        host_delay=args.host_delay,
+        segments=args.segments,
+        cache=HttpCache(args.cache, args.cache_size << 20) if args.cache else None,
+    )
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGINT, downloader.is_idle)
+    try:
+        async with downloader:
+            for url in read_urls(args):
+                await downloader.queue_download(url, args.output)
 
     except KeyboardInterrupt:
         pass
@@ -76,6 +396,10 @@ async def asy_main(args):
     finally:
         loop.remove_signal_handler(signal.SIGINT)
 
+    print(
+        f"Downloaded {len(downloader.completed)} files, {len(downloader.failed)} failed"
+    )
+
 
 def main():
     parser = argparse.ArgumentParser(description="Asynchronous web downloader")
@@ -87,6 +411,39 @@ def main():
     parser.add_argument(
         "-c", "--concurrency", type=int, default=3, help="Maximum concurrent downloads"
     )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1 << 20,
+        help="Bytes received before each file write",
+    )
+    parser.add_argument(
+        "-s",
+        "--segments",
+        type=int,
+        default=1,
+        help="Parallel byte ranges per large download, if the server supports them",
+    )
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help="Directory to cache downloads in for conditional re-downloads",
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=1024, help="Cache size limit in MiB"
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=2,
+        help="Maximum concurrent downloads from one host",
+    )
+    parser.add_argument(
+        "--host-delay",
+        type=float,
+        default=0.0,
+        help="Minimum seconds between the starts of requests to one host",
+    )
 
     args = parser.parse_args()
 
@@ -94,9 +451,8 @@ def main():
         print("Please provide either a list of URLs or a file containing URLs.")
         exit(1)
 
-    if args.file:
-        with open(args.file, "r") as f:
-            urls_from_file = f.read().splitlines()
-        args.urls.extend(urls_from_file)
-
     asyncio.run(asy_main(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""On-disk HTTP cache for conditional requests.
+
+Bodies are kept in the `bodies` subdirectory of the cache directory, named by
+the sha256 of their URL, and `index.json` keeps each URL's ETag,
+Last-Modified and charset in least recently used order. A cached URL is
+requested again with If-None-Match and If-Modified-Since; on a 304 the body
+comes from the cache and the transfer is just the headers. When the bodies
+add up to more than max_bytes the least recently used ones are dropped.
+
+Downloaded files are copied into and out of the cache rather than linked, so
+editing a download never changes the cached body. On file systems with
+reflinks (btrfs, xfs, ...) the copies share their blocks until one is
+written to, so they cost no extra space; elsewhere shutil.copyfile copies in
+the kernel.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+INDEX = "index.json"
+BODIES = "bodies"
+
+# ioctl making a file share another's blocks copy-on-write
+FICLONE = 0x40049409
+
+
+def _clone(source: str, destination: str):
+    """Copy source to destination, as a reflink where the file system supports it"""
+    if fcntl is not None:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, destination)
+
+
+def _key(url: str) -> str:
+    return sha256(url.encode()).hexdigest()
+
+
+class HttpCache:
+    def __init__(self, directory: str, max_bytes: int = 1 << 30):
+        self.directory = directory
+        self.bodies = os.path.join(directory, BODIES)
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[str, dict] = OrderedDict()
+        self.size = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.bodies, _key(url))
+
+    def load(self):
+        os.makedirs(self.bodies, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, INDEX)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = []
+        for entry in entries:
+            if os.path.exists(self._path(entry["url"])):
+                self.entries[entry["url"]] = entry
+                self.size += entry["size"]
+        # bodies stored after the index was last saved, and interrupted stores
+        known = {_key(url) for url in self.entries}
+        with os.scandir(self.bodies) as it:
+            for entry in it:
+                if entry.name not in known and entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+        self._evict()
+
+    def save(self):
+        with self._lock:
+            entries = list(self.entries.values())
+        tmp = os.path.join(self.directory, INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp, os.path.join(self.directory, INDEX))
+
+    def headers(self, url: str) -> dict[str, str]:
+        """Conditional request headers for url, empty if it isn't cached"""
+        entry = self.entries.get(url)
+        if entry is None:
+            return {}
+        headers = {}
+        if entry["etag"]:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"]:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def hit(self, url: str) -> str:
+        """Path of url's cached body after a 304, None if it has been evicted since.
+
+        Another thread can still evict the body before it is read, the callers
+        treat a body that is gone as a miss.
+        """
+        with self._lock:
+            if url not in self.entries:
+                return None
+            self.entries.move_to_end(url)
+        return self._path(url)
+
+    def charset(self, url: str) -> str:
+        """Charset url's cached body was served with, None if unknown"""
+        entry = self.entries.get(url)
+        return None if entry is None else entry.get("charset")
+
+    def read(self, url: str) -> bytes:
+        path = self.hit(url)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def restore(self, url: str, destination: str) -> bool:
+        """Put url's cached body at destination, False if it isn't cached"""
+        path = self.hit(url)
+        if path is None:
+            return False
+        tmp = destination + ".cached"
+        try:
+            _clone(path, tmp)
+            os.replace(tmp, destination)
+        except BaseException as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            # evicted by a store on another thread since hit()
+            if isinstance(e, FileNotFoundError) and not os.path.exists(path):
+                return False
+            raise
+        return True
+
+    def store(
+        self,
+        url: str,
+        headers,
+        data: bytes = None,
+        source: str = None,
+        charset: str = None,
+    ):
+        """Cache data or the file at source as url's body, if it can be revalidated"""
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        size = os.path.getsize(source) if source is not None else len(data)
+        if size > self.max_bytes:
+            return
+        path = self._path(url)
+        # unique, so stores of one URL on several threads don't share it
+        fd, tmp = tempfile.mkstemp(".tmp", dir=self.bodies)
+        try:
+            if source is not None:
+                os.close(fd)
+                _clone(source, tmp)
+            else:
+                with open(fd, "wb") as f:
+                    f.write(data)
+            size = os.path.getsize(tmp)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+        with self._lock:
+            os.replace(tmp, path)
+            old = self.entries.pop(url, None)
+            if old is not None:
+                self.size -= old["size"]
+            self.entries[url] = {
+                "url": url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "charset": charset,
+                "size": size,
+            }
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            url, entry = self.entries.popitem(last=False)
+            self.size -= entry["size"]
+            try:
+                os.remove(self._path(url))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,119 @@
+"""Host-aware scheduling so one origin can't take every download slot.
+
+`HostQueue` is a drop-in for the `asyncio.Queue` of downloads: items are
+handed out round-robin across hosts, at most `per_host` items of a host are
+out at once (until `task_done`), and consecutive requests to a host start at
+least `delay` seconds apart. Workers blocked on one busy host just get an
+item from another one, so overall throughput stays up.
+"""
+
+import asyncio
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+
+def host(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class HostQueue:
+    def __init__(
+        self, maxsize=0, per_host=2, delay=0.0, key=lambda item: host(item[0])
+    ):
+        self.maxsize = maxsize
+        self.per_host = per_host
+        self.delay = delay
+        self.key = key
+        self._queues: dict[str, deque] = {}
+        self._order: deque[str] = deque()
+        self._active: dict[str, int] = defaultdict(int)
+        self._started: dict[str, float] = {}
+        self._size = 0
+        self._unfinished = 0
+        self._changed = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def qsize(self):
+        return self._size
+
+    def empty(self):
+        return not self._size
+
+    def full(self):
+        return 0 < self.maxsize <= self._size
+
+    async def _wait(self, timeout=None):
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def put_nowait(self, item):
+        key = self.key(item)
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._order.append(key)
+        queue.append(item)
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._changed.set()
+
+    async def put(self, item):
+        while self.full():
+            await self._wait()
+        self.put_nowait(item)
+
+    def _pick(self, now: float):
+        """Next item of the first eligible host in round-robin order.
+
+        Without one, returns the seconds until a host is eligible.
+        """
+        wait = None
+        for _ in range(len(self._order)):
+            key = self._order[0]
+            self._order.rotate(-1)
+            if self._active[key] >= self.per_host:
+                continue
+            ready = self._started.get(key, now - self.delay) + self.delay
+            if ready > now:
+                wait = ready - now if wait is None else min(wait, ready - now)
+                continue
+
+            queue = self._queues[key]
+            item = queue.popleft()
+            if not queue:
+                # rotated to the back above
+                del self._queues[key]
+                self._order.pop()
+            self._active[key] += 1
+            self._started[key] = now
+            self._size -= 1
+            return item, None
+        return None, wait
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item, wait = self._pick(loop.time())
+            if item is not None:
+                self._changed.set()
+                return item
+            await self._wait(wait)
+
+    def task_done(self, item):
+        """Release the host slot item was holding"""
+        key = self.key(item)
+        self._active[key] -= 1
+        if not self._active[key]:
+            del self._active[key]
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._finished.set()
+        self._changed.set()
+
+    async def join(self):
+        await self._finished.wait()
@@ -0,0 +1,101 @@
+"""Partial downloads that survive an interrupted run.
+
+A download is written to `<file>.part`, next to a `<file>.part.json` sidecar
+holding the URL, the response's validator (ETag, or Last-Modified when there
+is no strong ETag) and how many bytes are safely on disk. A later run asks
+for the rest with `Range: bytes=<offset>-` and `If-Range: <validator>`: if
+the resource is unchanged the server answers 206 with just the missing
+bytes, otherwise 200 with the whole new body and the part is started over.
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass
+
+PART_SUFFIX = ".part"
+SIDECAR_SUFFIX = ".part.json"
+
+
+@dataclass
+class Partial:
+    path: str
+    url: str
+    etag: str = None
+    last_modified: str = None
+    offset: int = 0
+
+    @property
+    def part(self) -> str:
+        return self.path + PART_SUFFIX
+
+    @property
+    def sidecar(self) -> str:
+        return self.path + SIDECAR_SUFFIX
+
+    @property
+    def validator(self) -> str:
+        """What If-Range can be checked against, weak ETags never match it"""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+    @classmethod
+    def load(cls, path: str, url: str) -> "Partial":
+        """The resumable part of path, or None if there is nothing usable on disk"""
+        try:
+            with open(path + SIDECAR_SUFFIX) as f:
+                state = json.load(f)
+            size = os.path.getsize(path + PART_SUFFIX)
+        except (OSError, ValueError):
+            return None
+        if state.get("url") != url:
+            return None
+        partial = cls(
+            path,
+            url,
+            state.get("etag"),
+            state.get("last_modified"),
+            state.get("offset", 0),
+        )
+        # bytes past the last saved offset may not have made it to disk whole
+        partial.offset = min(partial.offset, size)
+        if not partial.offset or partial.validator is None:
+            return None
+        return partial
+
+    def headers(self) -> dict[str, str]:
+        return {"Range": f"bytes={self.offset}-", "If-Range": self.validator}
+
+    def save(self):
+        state = asdict(self)
+        del state["path"]
+        tmp = self.sidecar + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.sidecar)
+
+    def open(self):
+        """The part file positioned at offset, with anything after it dropped"""
+        f = open(self.part, "r+b" if self.offset else "wb")
+        f.seek(self.offset)
+        f.truncate()
+        self.save()
+        return f
+
+    def append(self, f, data):
+        f.write(data)
+        f.flush()
+        self.offset += len(data)
+        self.save()
+
+    def finish(self):
+        """Move the finished part into place"""
+        os.replace(self.part, self.path)
+        self.discard()
+
+    def discard(self):
+        for path in (self.part, self.sidecar):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
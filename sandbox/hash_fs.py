@@ -1,6 +1,10 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import Field, dataclass
 import glob
 from hashlib import sha256
+import os
+import sys
+import time
 from uuid import uuid4
 
 
@@ -10,14 +14,14 @@ class Node:
         self._parent = None
         self._children = children or []
 
-        self._hid = self.__calculate_hash()
+        self._hid = self._calculate_hash()
 
     @property
     def hid(self):
         return self._hid
 
     @hid.setter
-    def set_hid(self, hid):
+    def hid(self, hid):
         self._hid = hid
 
     @property
@@ -42,11 +46,13 @@ class Node:
     def children(self):
         return self._children
 
-    def __calculate_hash(self):
+    def _calculate_hash(self):
         if len(self._children) == 0:
             return sha256(self._data).hexdigest()
         else:
-            return sha256(b"".join([child.hid for child in self._children])).hexdigest()
+            return sha256(
+                "".join([child.hid for child in self._children]).encode()
+            ).hexdigest()
 
     def __get_path_to_root(self, node: "Node"):
         """Get the path from node to root. Assumes that node is in the tree."""
@@ -59,7 +65,7 @@ class Node:
     def __update_node_hashes(self, changed_node: "Node"):
         """Update hashes of all nodes in the path from changed_node to root"""
         for node in self.__get_path_to_root(changed_node):
-            node.set_hid(node.__calculate_hash())
+            node.hid = node._calculate_hash()
 
     def __str__(self):
         return self.hid
@@ -83,10 +89,134 @@ class HashTree:
         child._parent = parent
 
 
+class FSNode(Node):
+    """Node for a filesystem entry, its data is the entry name.
+
+    Like `FSNode` in experiments/look, a node hashes its name, the digest of
+    its content (files) and the hids of its children (directories), so
+    renaming or moving an entry changes the root.
+    """
+
+    def __init__(self, name, digest=b"", children=None):
+        self.name = name
+        self.digest = digest
+        super().__init__(os.fsencode(name), children)
+
+    def _calculate_hash(self):
+        parts = [sha256(self._data).hexdigest(), self.digest.hex()]
+        parts += [child.hid for child in self._children]
+        return sha256("".join(parts).encode()).hexdigest()
+
+
+def hash_file(path):
+    """Content digest and size of the file at path, None if it can't be read"""
+    sha = sha256()
+    size = 0
+    try:
+        with open(path, "rb") as f:
+            while chunk := f.read(1 << 20):
+                sha.update(chunk)
+                size += len(chunk)
+    except OSError:
+        return None
+    return sha.digest(), size
+
+
+def scan_dir(path):
+    """List the subdirectories and regular files in path, symlinks are skipped.
+
+    A directory that can't be read lists as empty and entries that can't be
+    stat'ed are left out.
+    """
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        files.append(entry.name)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return dirs, files
+
+
 class FSIndex:
-    """Index for file system"""
+    """Index for file system.
 
-    ...
+    Directories are listed with os.scandir and files hashed on one thread
+    pool (hashlib releases the GIL), so both the walk and the hashing run on
+    every core. Once everything is in, the tree is built bottom-up, one hash
+    per directory.
+    """
+
+    def __init__(self, path, workers=None):
+        self.path = path
+        self.workers = workers or os.cpu_count()
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def _walk(self, pool):
+        """Scan and hash everything under self.path.
+
+        Returns the (dirs, files) listing of every directory and the
+        (digest, size) of every readable file, keyed by path.
+        """
+        listings, hashed = {}, {}
+        pending = {pool.submit(scan_dir, self.path): (scan_dir, self.path)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, path = pending.pop(future)
+                if kind is hash_file:
+                    if future.result() is not None:
+                        hashed[path] = future.result()
+                    continue
+                dirs, files = listings[path] = future.result()
+                for name in dirs:
+                    sub = os.path.join(path, name)
+                    pending[pool.submit(scan_dir, sub)] = (scan_dir, sub)
+                for name in files:
+                    sub = os.path.join(path, name)
+                    pending[pool.submit(hash_file, sub)] = (hash_file, sub)
+        return listings, hashed
+
+    def build(self):
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.workers) as pool:
+            listings, hashed = self._walk(pool)
+
+        nodes = {}
+        # deepest first, so every subdirectory is built before its parent
+        for path in sorted(listings, key=lambda p: p.count(os.sep), reverse=True):
+            dirs, files = listings[path]
+            children = [nodes.pop(os.path.join(path, name)) for name in dirs]
+            for name in files:
+                result = hashed.get(os.path.join(path, name))
+                if result is not None:
+                    children.append(FSNode(name, result[0]))
+                    self.files += 1
+                    self.bytes += result[1]
+            children.sort(key=lambda child: child.name)
+
+            node = FSNode(os.path.basename(path), children=children)
+            for child in children:
+                child._parent = node
+            nodes[path] = node
+
+        self.seconds = time.perf_counter() - start
+        return HashTree(nodes[self.path])
+
+    def report(self):
+        return (
+            f"{self.files} files, {self.bytes} bytes in {self.seconds:.2f}s "
+            f"({self.files / self.seconds:.0f} files/s, "
+            f"{self.bytes / self.seconds / (1 << 20):.1f} MiB/s)"
+        )
 
 
 def main():
@@ -115,6 +245,11 @@ def main():
 
     print(T.root)
 
+    if len(sys.argv) > 1:
+        index = FSIndex(sys.argv[1])
+        print(index.build().root)
+        print(index.report())
+
 
 if __name__ == "__main__":
     main()